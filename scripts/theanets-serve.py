@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import climate
+import numpy as np
+import theanets
+import threading
+
+logging = climate.get_logger('theanets-serve')
+
+@climate.annotate(
+    model='serve the network (.pkl[.gz]) or inference engine (.npz) in FILE',
+    method=('call model method NAME on each batch', 'option'),
+    max_batch_size=('compute at most N rows per batch', 'option', None, int),
+    max_wait=('wait at most S seconds to fill a batch', 'option', None, float),
+    port=('serve HTTP requests on port N', 'option', None, int),
+    host=('serve HTTP requests on address HOST', 'option'),
+    socket=('serve requests on unix socket PATH', 'option'),
+    benchmark=('benchmark using inputs from .npy FILE, then exit', 'option'),
+    clients=('benchmark with N concurrent clients', 'option', None, int),
+    requests=('benchmark with N requests', 'option', None, int),
+)
+def main(model, method='predict', max_batch_size=64, max_wait=0.002,
+         port=8000, host='127.0.0.1', socket=None, benchmark=None,
+         clients=16, requests=1000):
+    if model.endswith('.npz'):
+        model = theanets.engine.Engine.load(model)
+    else:
+        model = theanets.feedforward.load(model)
+    server = theanets.serve.Server(
+        model, method, max_batch_size=max_batch_size, max_wait=max_wait)
+    if benchmark:
+        x = np.load(benchmark, mmap_mode='r')
+        # models are not thread-safe, so unbatched calls must be serialized.
+        compute, lock = getattr(model, method), threading.Lock()
+        def unbatched(x):
+            with lock:
+                return np.array(compute(x[None]))
+        for name, predict in (('unbatched', unbatched), ('batched', server)):
+            report = theanets.serve.benchmark(predict, x, clients, requests)
+            logging.info('%s: %s', name, ' '.join(
+                '{}={:.2f}'.format(k, v) for k, v in report.items()))
+        logging.info('computed %d requests in %d batches',
+                     server.requests, server.batches)
+        return
+    if socket:
+        frontend = theanets.serve.unix_frontend(server, socket)
+    else:
+        frontend = theanets.serve.http_frontend(server, host, port)
+    try:
+        frontend.serve_forever()
+    finally:
+        frontend.server_close()
+        server.close()
+
+
+if __name__ == '__main__':
+    climate.call(main)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+import climate
+import importlib
+import numpy as np
+import theanets
+
+logging = climate.get_logger('theanets-shard')
+
+@climate.annotate(
+    target='write sharded dataset to directory DIR',
+    samples=('load samples from .npy FILE', 'option'),
+    labels=('load labels from .npy FILE', 'option'),
+    source=('generate batches by calling MODULE:FUNC', 'option'),
+    batches=('call the batch generator N times', 'option', None, int),
+    shard_size=('store N samples in each shard', 'option', None, int),
+    axis=('split arrays into samples along axis N', 'option', None, int),
+)
+def main(target, samples=None, labels=None, source=None, batches=100,
+         shard_size=65536, axis=0):
+    if source:
+        module, name = source.split(':')
+        generate = getattr(importlib.import_module(module), name)
+        with theanets.dataset.ShardWriter(target, shard_size, axis) as writer:
+            for _ in range(batches):
+                batch = generate()
+                if isinstance(batch, np.ndarray):
+                    batch = (batch, )
+                writer.append(*batch)
+    elif samples:
+        samples = np.load(samples, mmap_mode='r')
+        if labels:
+            labels = np.load(labels, mmap_mode='r')
+        theanets.dataset.write_shards(
+            target, samples, labels, shard_size=shard_size, axis=axis)
+    else:
+        raise ValueError('either --samples or --source is required')
+    logging.info('wrote sharded dataset to %s', target)
+
+
+if __name__ == '__main__':
+    climate.call(main)
@@ -0,0 +1,87 @@
+import numpy as np
+import os
+import shutil
+import tempfile
+import theano
+import theano.tensor as TT
+
+import theanets
+
+
+class TestFunctionCache:
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def build(self, value):
+        x = TT.vector('x')
+        w = theano.shared(np.zeros(3, theano.config.floatX) + value, name='w')
+        return x, w, [(w, w + 1)]
+
+    def test_reuse(self):
+        cache = theanets.cache.FunctionCache(self.path)
+        x, w, updates = self.build(1)
+        f = cache.function([x], [TT.dot(x, w)], updates=updates)
+        assert len(os.listdir(self.path)) == 1
+        assert np.allclose(f(np.ones(3, theano.config.floatX)), 3)
+
+        # the cached function operates on the new shared variable.
+        x, w, updates = self.build(5)
+        f = cache.function([x], [TT.dot(x, w)], updates=updates)
+        assert len(os.listdir(self.path)) == 1
+        assert np.allclose(f(np.ones(3, theano.config.floatX)), 15)
+        assert np.allclose(w.get_value(), 6)
+
+    def test_no_reoptimize(self):
+        cache = theanets.cache.FunctionCache(self.path)
+        x, w, _ = self.build(1)
+        cache.function([x], [TT.dot(x, w)])
+
+        # loading the stored function must not run the graph optimizer.
+        calls = []
+        default = theano.config.reoptimize_unpickled_function
+        optimize = theano.gof.opt.Optimizer.__call__
+        def spy(*args, **kwargs):
+            calls.append(args)
+            return optimize(*args, **kwargs)
+        theano.config.reoptimize_unpickled_function = True
+        theano.gof.opt.Optimizer.__call__ = spy
+        try:
+            x, w, _ = self.build(5)
+            f = cache.function([x], [TT.dot(x, w)])
+            assert theano.config.reoptimize_unpickled_function
+        finally:
+            theano.gof.opt.Optimizer.__call__ = optimize
+            theano.config.reoptimize_unpickled_function = default
+        assert not calls
+        assert np.allclose(f(np.ones(3, theano.config.floatX)), 15)
+
+    def test_constants(self):
+        # these transforms print the same, since theano abbreviates large
+        # constants, but they must not share a cached function.
+        cache = theanets.cache.FunctionCache(self.path)
+        x = TT.matrix('x')
+        one = np.zeros(100, theano.config.floatX)
+        two = one.copy()
+        two[50] = 1
+        cache.function([x], [theanets.preprocess.Affine(one)(x)])
+        f = cache.function([x], [theanets.preprocess.Affine(two)(x)])
+        assert len(os.listdir(self.path)) == 2
+        assert np.allclose(f(np.ones((1, 100), theano.config.floatX))[0],
+                           1 - two)
+
+    def test_key(self):
+        cache = theanets.cache.FunctionCache(self.path)
+        x, w, _ = self.build(1)
+        cache.function([x], [TT.dot(x, w)], key=('a', ))
+        cache.function([x], [TT.dot(x, w)], key=('b', ))
+        assert len(os.listdir(self.path)) == 2
+
+    def test_evict(self):
+        cache = theanets.cache.FunctionCache(self.path, max_size=1)
+        x, w, _ = self.build(1)
+        cache.function([x], [TT.dot(x, w)], key=('a', ))
+        cache.function([x], [TT.dot(x, w)], key=('b', ))
+        assert len(os.listdir(self.path)) == 0
@@ -1,4 +1,12 @@
+import json
 import numpy as np
+import os
+import scipy.sparse
+import shutil
+import tempfile
+import theano
+import theano.tensor as TT
+
 import theanets
 
 
@@ -36,3 +44,312 @@ class TestDataset:
             assert x.shape == (5, 10, 3) or x.shape == (5, 2, 3)
             i += 1
         assert i == 13
+
+    def test_memmap(self):
+        handle, path = tempfile.mkstemp(suffix='.npy')
+        os.close(handle)
+        try:
+            np.save(path, np.random.randn(100, 2))
+            dataset = theanets.dataset.Dataset(
+                path, iteration_size=4, batch_size=10)
+
+            # only batch offsets are stored for memory-mapped data.
+            assert len(dataset.batches) == 10
+            assert all(isinstance(b, slice) for b in dataset.batches)
+
+            i = 0
+            for x, in dataset:
+                assert isinstance(x, np.memmap)
+                assert x.shape == (10, 2)
+                i += 1
+            assert i == 4
+        finally:
+            os.unlink(path)
+
+    def test_shuffle_samples(self):
+        dataset = theanets.dataset.Dataset(
+            np.arange(100).reshape((50, 2)), batch_size=10,
+            shuffle_samples=True)
+
+        def epoch():
+            return [tuple(sorted(x[:, 0])) for x, in dataset]
+
+        first = epoch()
+        assert sorted(i for b in first for i in b) == list(range(0, 100, 2))
+
+        # batch compositions change from one epoch to the next.
+        second = epoch()
+        assert set(first) != set(second)
+
+    def test_prefetch(self):
+        dataset = theanets.dataset.Dataset(
+            np.arange(100).reshape((50, 2)), batch_size=10,
+            shuffle_samples=True, prefetch=2)
+        batches = [x.copy() for x, in dataset]
+        assert len(batches) == 5
+        assert sorted(np.concatenate(batches)[:, 0]) == list(range(0, 100, 2))
+
+    def test_prefetch_callable(self):
+        dataset = theanets.dataset.Dataset(
+            lambda: [np.zeros((4, 2))], iteration_size=7,
+            prefetch=3, prefetch_threads=2)
+        assert sum(1 for _ in dataset) == 7
+
+    def test_workers(self):
+        def batch():
+            return [np.random.randn(4, 2), np.arange(4)]
+        dataset = theanets.dataset.Dataset(batch, iteration_size=6, workers=2)
+        try:
+            i = 0
+            for x, y in dataset:
+                assert x.shape == (4, 2)
+                assert list(y) == [0, 1, 2, 3]
+                i += 1
+            assert i == 6
+        finally:
+            dataset.close()
+
+    def test_resident(self):
+        dataset = theanets.dataset.Dataset(
+            np.random.randn(100, 2), iteration_size=4, batch_size=30,
+            resident=True)
+        offsets = list(dataset.iterate_offsets())
+        assert len(offsets) == 4
+        assert all(stop - start == 30 for start, stop in offsets)
+        x = TT.matrix('x')
+        (var, expr), = dataset.givens([x], 0, 30)
+        assert var is x
+        assert expr.eval().shape == (30, 2)
+
+    def test_sparse(self):
+        samples = scipy.sparse.random(100, 20, density=0.05, format='csr')
+        labels = np.arange(100)
+        dataset = theanets.dataset.Dataset(
+            samples, labels, batch_size=30, shuffle_samples=True)
+        count = 0
+        for x, y in dataset:
+            assert scipy.sparse.isspmatrix_csr(x)
+            assert x.shape[1] == 20
+            assert np.allclose(x.toarray(), samples[y].toarray())
+            count += x.shape[0]
+        assert count == 100
+
+    def test_quantize(self):
+        samples = np.random.randn(100, 3).astype('f')
+        samples[:, 2] = 7
+        dataset = theanets.dataset.Dataset(
+            samples, batch_size=30, quantize='uint8')
+        assert dataset._arrays[0].dtype == np.uint8
+        step = (samples.max(axis=0) - samples.min(axis=0)) / 255
+        for x, in dataset:
+            assert x.dtype == theano.config.floatX
+            assert x.shape[1] == 3
+            assert (x[:, 2] == 7).all()
+        x, = dataset._batch(slice(0, 100))
+        assert (abs(x - samples).max(axis=0) <= step).all()
+
+    def test_quantize_float16(self):
+        samples = np.random.randn(100, 3).astype('f')
+        dataset = theanets.dataset.Dataset(
+            samples, batch_size=30, shuffle_samples=True, quantize='float16')
+        assert dataset._arrays[0].dtype == np.float16
+        for x, in dataset:
+            assert x.dtype == theano.config.floatX
+
+    def test_transform(self):
+        dataset = theanets.dataset.Dataset(
+            np.ones((100, 2)), np.zeros(100), batch_size=30,
+            transform=lambda x: x * 3)
+        for x, y in dataset:
+            assert (x == 3).all()
+            assert (y == 0).all()
+
+    def test_state(self):
+        samples = np.arange(100)[:, None]
+        dataset = theanets.dataset.Dataset(
+            samples, batch_size=10, iteration_size=7, shuffle_samples=True,
+            rng=3)
+        list(dataset)
+        state = dataset.get_state()
+        expected = [x.copy() for _ in range(3) for x, in dataset]
+        other = theanets.dataset.Dataset(
+            samples, batch_size=10, iteration_size=7, shuffle_samples=True,
+            rng=4)
+        other.set_state(state)
+        actual = [x.copy() for _ in range(3) for x, in other]
+        assert all((a == e).all() for a, e in zip(actual, expected))
+
+
+class TestValidationSubset:
+    def test_iterate_fixed(self):
+        dataset = theanets.dataset.Dataset(
+            np.arange(100)[:, None], batch_size=10)
+        first = [x[0, 0] for x, in dataset.iterate_fixed()]
+        list(dataset)
+        list(dataset)
+        second = [x[0, 0] for x, in dataset.iterate_fixed()]
+        assert first == list(range(0, 100, 10))
+        assert first == second
+
+    def test_iterate_fixed_shuffle_samples(self):
+        dataset = theanets.dataset.Dataset(
+            np.arange(100)[:, None], batch_size=10, shuffle_samples=True)
+        first = [x[:, 0].copy() for x, in dataset.iterate_fixed()]
+        list(dataset)
+        list(dataset)
+        second = [x[:, 0].copy() for x, in dataset.iterate_fixed()]
+        for i, (a, b) in enumerate(zip(first, second)):
+            assert list(a) == list(b) == list(range(10 * i, 10 * i + 10))
+
+    def test_stratified(self):
+        samples = np.arange(200)[:, None]
+        labels = np.repeat([0, 1, 2, 3], [100, 50, 30, 20]).astype('i')
+        x, y = theanets.dataset.stratified_subset(samples, labels, 20)
+        assert len(x) == len(y) == 20
+        assert list(np.bincount(y)) == [10, 5, 3, 2]
+        assert (labels[x[:, 0]] == y).all()
+        x2, y2 = theanets.dataset.stratified_subset(samples, labels, 20)
+        assert (x == x2).all()
+
+
+class TestKeyedDataset:
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def batch(self, key):
+        self.calls.append(key)
+        return [np.full((4, 2), key, 'f'), np.arange(4)]
+
+    def test_iterate(self):
+        dataset = theanets.dataset.Dataset(self.batch, keys=range(5))
+        assert dataset.iteration_size == 5
+        for _ in range(2):
+            keys = sorted(int(x[0, 0]) for x, y in dataset)
+            assert keys == list(range(5))
+        assert len(self.calls) == 10
+
+    def test_cache(self):
+        dataset = theanets.dataset.Dataset(
+            self.batch, keys=range(5), cache_size=5)
+        for _ in range(3):
+            assert sum(1 for _ in dataset) == 5
+        assert sorted(self.calls) == list(range(5))
+        assert dataset._cache.hits == 10
+
+    def test_spill(self):
+        dataset = theanets.dataset.Dataset(
+            self.batch, keys=range(5), cache_size=2, cache_dir=self.path)
+        for _ in range(3):
+            for x, y in dataset:
+                assert x.shape == (4, 2)
+                assert list(y) == [0, 1, 2, 3]
+        assert sorted(self.calls) == list(range(5))
+        assert len(os.listdir(self.path)) >= 3
+
+
+class TestImportanceDataset:
+    def test_iterate(self):
+        dataset = theanets.dataset.ImportanceDataset(
+            np.arange(100)[:, None], batch_size=10, iteration_size=200,
+            uniform=0.1)
+        counts = np.zeros(10)
+        for x, in dataset:
+            i = x[0, 0] // 10
+            counts[i] += 1
+            assert np.isclose(dataset.weight,
+                              1 / (10 * dataset.probabilities()[i]))
+            dataset.observe(100. if i == 3 else 1.)
+        assert counts.argmax() == 3
+        assert (counts > 0).all()
+
+    def test_no_shuffle_samples(self):
+        try:
+            theanets.dataset.ImportanceDataset(
+                np.zeros((10, 2)), shuffle_samples=True)
+            assert False
+        except ValueError:
+            pass
+
+
+class TestSequenceDataset:
+    def setUp(self):
+        self.lengths = [3, 7, 5, 3, 9, 7, 4, 8]
+        self.samples = [np.random.randn(n, 2) for n in self.lengths]
+        self.labels = [np.arange(n).astype('i') for n in self.lengths]
+
+    def test_iterate(self):
+        dataset = theanets.dataset.SequenceDataset(
+            self.samples, self.labels, batch_size=3)
+        assert len(dataset.batches) == 3
+        count = 0
+        for x, y, mask in dataset:
+            assert x.shape[:2] == mask.shape
+            assert y.shape == mask.shape
+            assert x.shape[2] == 2
+            lengths = mask.sum(axis=0)
+            assert x.shape[0] == lengths.max()
+            assert (x[mask == 0] == 0).all()
+            count += len(lengths)
+        assert count == len(self.lengths)
+
+    def test_buckets(self):
+        dataset = theanets.dataset.SequenceDataset(self.samples, batch_size=2)
+        steps = sorted(x.shape[0] for x, mask in dataset)
+        assert steps == [3, 5, 7, 9]
+
+
+class TestShardedDataset:
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.samples = np.random.randn(100, 3).astype('f')
+        self.labels = np.arange(100).astype('i')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_write(self):
+        theanets.dataset.write_shards(
+            self.path, self.samples, self.labels, shard_size=30)
+        with open(os.path.join(self.path, 'index.json')) as handle:
+            index = json.load(handle)
+        assert [s['offset'] for s in index['shards']] == [0, 30, 60, 90]
+        assert [s['size'] for s in index['shards']] == [30, 30, 30, 10]
+        assert index['shards'][0]['arrays'][0]['shape'] == [30, 3]
+
+    def test_writer(self):
+        with theanets.dataset.ShardWriter(self.path, shard_size=40) as writer:
+            for i in range(0, 100, 7):
+                writer.append(self.samples[i:i+7], self.labels[i:i+7])
+        assert [s['size'] for s in writer.shards] == [40, 40, 20]
+
+    def test_iterate(self):
+        theanets.dataset.write_shards(
+            self.path, self.samples, self.labels, shard_size=30)
+        dataset = theanets.dataset.ShardedDataset(
+            self.path, batch_size=16, buffer_size=50)
+        assert dataset.iteration_size == 7
+        for _ in range(2):
+            seen = []
+            for x, y in dataset:
+                assert len(x) == len(y) <= 16
+                assert np.allclose(x, self.samples[y])
+                seen.extend(y)
+            assert sorted(seen) == list(range(100))
+
+    def test_state(self):
+        theanets.dataset.write_shards(
+            self.path, self.samples, self.labels, shard_size=30)
+        dataset = theanets.dataset.ShardedDataset(
+            self.path, batch_size=16, iteration_size=3)
+        list(dataset)
+        state = dataset.get_state()
+        expected = [y for _ in range(3) for x, y in dataset]
+        other = theanets.dataset.ShardedDataset(
+            self.path, batch_size=16, iteration_size=3)
+        other.set_state(state)
+        actual = [y for _ in range(3) for x, y in other]
+        assert all((a == e).all() for a, e in zip(actual, expected))
@@ -0,0 +1,84 @@
+import numpy as np
+import os
+import subprocess
+import sys
+import tempfile
+import theanets
+
+import util
+
+
+class TestEngine(util.MNIST):
+    def assert_matches(self, net):
+        engine = theanets.engine.Engine.from_network(net, sample=self.images)
+        assert np.allclose(engine.predict(self.images),
+                           net.predict(self.images), atol=1e-4)
+        return engine
+
+    def test_regressor(self):
+        self.assert_matches(theanets.Regressor(
+            layers=(self.DIGIT_SIZE, 15, 13), hidden_activation='relu'))
+
+    def test_classifier(self):
+        self.assert_matches(theanets.Classifier(
+            layers=(self.DIGIT_SIZE, 15, 10), hidden_activation='tanh'))
+
+    def test_tied(self):
+        self.assert_matches(theanets.Autoencoder(
+            layers=(self.DIGIT_SIZE, 15, self.DIGIT_SIZE), tied_weights=True))
+
+    def test_decode_from(self):
+        self.assert_matches(theanets.Regressor(
+            layers=(self.DIGIT_SIZE, 13, 14, 15), decode_from=2))
+
+    def test_save_load(self):
+        net = theanets.Regressor(layers=(self.DIGIT_SIZE, 15, 13))
+        engine = self.assert_matches(net)
+        handle, path = tempfile.mkstemp(suffix='.npz')
+        os.close(handle)
+        try:
+            engine.save(path)
+            loaded = theanets.engine.Engine.load(path)
+            assert np.allclose(loaded.predict(self.images),
+                               net.predict(self.images), atol=1e-4)
+        finally:
+            os.unlink(path)
+
+    def test_quantize_int8(self):
+        net = theanets.Classifier(layers=(self.DIGIT_SIZE, 15, 10))
+        engine = self.assert_matches(net).quantize('int8')
+        assert engine.layers[1]['weights'][0].dtype == np.int8
+        report = engine.report(net, self.images, self.labels)
+        assert report['max_error'] < 0.1
+        assert report['agreement'] > 80
+        assert 'accuracy_delta' in report
+
+    def test_quantize_float16(self):
+        net = theanets.Autoencoder(
+            layers=(self.DIGIT_SIZE, 15, self.DIGIT_SIZE), tied_weights=True)
+        engine = self.assert_matches(net)
+        small = engine.quantize('float16')
+        assert small.nbytes < engine.nbytes
+        assert small.report(net, self.images)['max_error'] < 0.01
+
+
+def test_import_without_theano():
+    # blocking the theano module makes importing it raise ImportError.
+    code = """if True:
+        import sys
+        sys.modules['theano'] = None
+        import numpy as np
+        import theanets.engine
+        w = np.eye(2, dtype='f')
+        engine = theanets.engine.Engine([
+            dict(name='in', form='input', activation='linear', inputs=[],
+                 weights=[], bias=None),
+            dict(name='out', form='feedforward', activation='relu',
+                 inputs=[0], weights=[w], bias=np.zeros(2, 'f'))])
+        assert np.allclose(engine.predict(-w), 0)
+        assert not hasattr(theanets, 'Network')
+        """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(
+        theanets.__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    subprocess.check_call([sys.executable, '-c', code], env=env)
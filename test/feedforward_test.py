@@ -1,5 +1,6 @@
 import theanets
 import numpy as np
+import scipy.sparse
 
 import util
 
@@ -24,6 +25,31 @@ class TestNetwork(util.MNIST):
         assert hs[1].shape == (self.NUM_DIGITS, 15)
         assert hs[2].shape == (self.NUM_DIGITS, 13)
 
+    def test_feed_forward_layers(self):
+        net = self._build(15, 13)
+        hs = net.feed_forward(self.images, layers=[-1, 'hid1'])
+        assert len(hs) == 2
+        assert hs[0].shape == (self.NUM_DIGITS, 13)
+        assert hs[1].shape == (self.NUM_DIGITS, 15)
+        assert np.allclose(hs[0], net.feed_forward(self.images)[-1])
+
+    def test_predict_chunked(self):
+        net = self._build(15, 13)
+        y = net.predict(self.images)
+        chunks = list(net.predict_iter(self.images, chunk_size=7))
+        assert len(chunks) == -(-self.NUM_DIGITS // 7)
+        assert np.allclose(np.concatenate(chunks), y)
+        out = np.zeros_like(y)
+        assert net.predict_chunked(self.images, chunk_size=7, out=out) is out
+        assert np.allclose(out, y)
+        gen = (self.images[i:i + 5] for i in range(0, self.NUM_DIGITS, 5))
+        assert np.allclose(net.predict_chunked(gen), y)
+
+    def test_predict_chunked_empty(self):
+        net = self._build(15, 13)
+        y = net.predict_chunked(self.images[:0], chunk_size=7)
+        assert y.shape == (0, 13)
+
     def test_decode_from(self):
         net = self._build(13, 14, 15, decode_from=2)
         hs = net.feed_forward(self.images)
@@ -33,6 +59,23 @@ class TestNetwork(util.MNIST):
         assert hs[2].shape == (self.NUM_DIGITS, 14)
         assert hs[3].shape == (self.NUM_DIGITS, 15)
 
+    def test_input_transform(self):
+        stats = theanets.preprocess.Statistics()
+        stats.update(self.images)
+        whiten = stats.whiten(components=20)
+        net = theanets.Regressor(layers=(20, 15, 13), input_transform=whiten)
+        y = net.predict(self.images)
+        assert y.shape == (self.NUM_DIGITS, 13)
+
+    def test_sparse_input(self):
+        np.random.seed(13)
+        dense = self._build(15, 13)
+        np.random.seed(13)
+        net = self._build(15, 13, input_type='sparse')
+        y = net.predict(scipy.sparse.csr_matrix(self.images))
+        assert y.shape == (self.NUM_DIGITS, 13)
+        assert np.allclose(y, dense.predict(self.images), atol=1e-5)
+
 
 class TestClassifier(util.MNIST):
     def _build(self, *hiddens, **kwargs):
@@ -85,6 +85,29 @@ class TestMaxout(Base):
         assert not upd
 
 
+class TestEmbedding(Base):
+    def _build(self):
+        return theanets.layers.Embedding(nin=2, nout=4, name='l')
+
+    def test_create(self):
+        self.assert_param_names(['xh'])
+        self.assert_count(8)
+
+    def test_transform(self):
+        out, mon, upd = self._build().transform(TT.imatrix('i'))
+        assert out.ndim == 3
+        assert len(mon) == 2
+        assert not upd
+
+    def test_one_hot(self):
+        layer = self._build()
+        index = TT.ivector('i')
+        out, _, _ = layer.transform(index)
+        ids = np.array([1, 0, 1], 'i')
+        table = layer.find('xh').get_value()
+        assert np.allclose(out.eval({index: ids}), np.eye(2)[ids].dot(table))
+
+
 class TestRNN(Base):
     def _build(self):
         return theanets.layers.RNN(nin=2, nout=4, name='l')
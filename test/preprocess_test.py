@@ -0,0 +1,85 @@
+import numpy as np
+
+import theanets
+
+
+class TestStatistics:
+    def setUp(self):
+        self.samples = np.random.randn(100, 4) * [1, 2, 3, 4] + [4, 3, 2, 1]
+        self.samples[:, 1] += self.samples[:, 0]
+
+    def test_update(self):
+        stats = theanets.preprocess.Statistics()
+        for i in range(0, 100, 7):
+            stats.update(self.samples[i:i+7])
+        assert stats.count == 100
+        assert np.allclose(stats.mean, self.samples.mean(axis=0))
+
+    def test_accumulate_position(self):
+        dataset = theanets.Dataset(self.samples, batch_size=30)
+        next(iter(dataset))
+        index = dataset._index
+        stats = theanets.preprocess.Statistics().accumulate(dataset, 2)
+        assert stats.count == 60
+        assert dataset._index == index
+        # asking for more batches than the dataset has stops after one pass.
+        stats = theanets.preprocess.Statistics().accumulate(dataset, 1000)
+        assert stats.count == 100
+        assert dataset._index == index
+
+    def test_standardize(self):
+        stats = theanets.preprocess.Statistics(covariance=False)
+        stats.update(self.samples)
+        z = stats.standardize()(self.samples)
+        assert np.allclose(z.mean(axis=0), 0, atol=1e-4)
+        assert np.allclose(z.std(axis=0), 1, atol=1e-4)
+
+    def test_whiten(self):
+        stats = theanets.preprocess.Statistics()
+        stats.update(self.samples)
+        whiten = stats.whiten(components=3)
+        assert whiten.nout == 3
+        z = whiten(self.samples)
+        assert z.shape == (100, 3)
+        assert np.allclose(np.cov(z.T, bias=True), np.eye(3), atol=1e-4)
+
+
+class TestAugmentation:
+    def setUp(self):
+        self.rng = np.random.RandomState(13)
+        self.images = np.arange(2 * 4 * 5 * 3).reshape((2, 60)).astype('f')
+
+    def test_flip(self):
+        flip = theanets.preprocess.RandomFlip((4, 5, 3), probability=1)
+        out = flip(self.images, self.rng).reshape((2, 4, 5, 3))
+        assert (out == self.images.reshape((2, 4, 5, 3))[:, :, ::-1]).all()
+
+    def test_crop(self):
+        crop = theanets.preprocess.RandomCrop((4, 5, 3), pad=2)
+        out = crop(self.images, self.rng)
+        assert out.shape == self.images.shape
+        imgs = self.images.reshape((2, 4, 5, 3))
+        padded = np.pad(imgs, [(0, 0), (2, 2), (2, 2), (0, 0)], 'constant')
+        for img, pad in zip(out.reshape((2, 4, 5, 3)), padded):
+            assert any((img == pad[r:r+4, c:c+5]).all()
+                       for r in range(5) for c in range(5))
+
+    def test_jitter(self):
+        jitter = theanets.preprocess.Jitter(brightness=1, contrast=0.5)
+        out = jitter(self.images, self.rng)
+        assert out.shape == self.images.shape
+        assert not np.allclose(out, self.images)
+
+    def test_dataset(self):
+        source = theanets.Dataset(self.images, np.arange(2), batch_size=1)
+        dataset = theanets.preprocess.AugmentedDataset(
+            source, [theanets.preprocess.Jitter(noise=1)], threads=2)
+        try:
+            for _ in range(3):
+                batches = list(dataset)
+                assert len(batches) == 2
+                for x, y in batches:
+                    assert x.shape == (1, 60)
+                    assert not np.allclose(x, self.images[y])
+        finally:
+            dataset.close()
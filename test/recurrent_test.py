@@ -1,5 +1,6 @@
-import theanets
 import numpy as np
+import theano
+import theanets
 
 INS = 3
 OUTS = 2
@@ -26,6 +27,35 @@ class TestFunctions:
         assert len(f()) == 1
         assert f()[0].shape == (STEPS, BATCH, INS)
 
+    def test_batches_windows(self):
+        f = theanets.recurrent.batches(
+            self.samples, self.labels, steps=STEPS, batch_size=BATCH)
+        x, y = f()
+        for i in range(BATCH):
+            j = abs(self.samples - x[0, i]).sum(axis=1).argmin()
+            assert np.allclose(x[:, i], self.samples[j:j+STEPS])
+            assert np.allclose(y[:, i], self.labels[j:j+STEPS])
+
+    def test_batches_without_replacement(self):
+        f = theanets.recurrent.batches(
+            self.samples, steps=STEPS, batch_size=BATCH, replace=False)
+        x, = f()
+        starts = set(tuple(row) for row in x[0])
+        assert len(starts) == BATCH
+
+    def test_batches_dtypes(self):
+        for dtype in ('f', 'i', 'int64', 'uint8'):
+            samples = (10 * abs(self.samples)).astype(dtype)
+            labels = (10 * abs(self.labels)).astype(dtype)
+            f = theanets.recurrent.batches(
+                samples, labels, steps=STEPS, batch_size=BATCH)
+            x, y = f()
+            assert x.dtype == y.dtype == theanets.recurrent.FLOAT
+            for i in range(BATCH):
+                assert any(np.allclose(x[:, i], samples[j:j+STEPS]) and
+                           np.allclose(y[:, i], labels[j:j+STEPS])
+                           for j in range(len(samples) - STEPS))
+
 
 class Base:
     def setUp(self):
@@ -37,6 +67,24 @@ class Base:
     def assert_shape(self, actual, expected):
         assert actual == expected, 'expected {}, got {}'.format(expected, actual)
 
+    def assert_masked(self, net, *targets):
+        # pad the end of every other sequence; changing the inputs and targets
+        # at padded steps must not change the loss.
+        mask = np.ones((STEPS, BATCH), 'f')
+        mask[STEPS - 4:, ::2] = 0
+        pad = mask == 0
+        loss = theano.function(net.inputs, net.loss()[0])
+        before = loss(self.probe, *(targets + (mask, )))
+        x = self.probe.copy()
+        x[pad] = 100 * np.random.randn(pad.sum(), INS)
+        targets = [t.copy() for t in targets]
+        for t in targets:
+            t[pad] = np.random.randint(OUTS, size=t[pad].shape)
+        assert np.allclose(loss(x, *(targets + [mask])), before)
+        # changing an unpadded step does change the loss.
+        x[0, 0] += 10
+        assert not np.allclose(loss(x, *(targets + [mask])), before)
+
 
 class TestNetwork(Base):
     def _build(self, *hiddens, **kwargs):
@@ -70,6 +118,11 @@ class TestNetwork(Base):
         self.assert_shape(hs[3].shape, (STEPS, BATCH, 15))
         self.assert_shape(hs[4].shape, (STEPS, BATCH, OUTS))
 
+    def test_mask(self):
+        for start in (0, 3):
+            net = self._build(13, mask=True, recurrent_error_start=start)
+            self.assert_masked(net, self.outputs[:, :BATCH])
+
 
 class TestPredictor(Base):
     def _build(self, *hiddens, **kwargs):
@@ -84,6 +137,11 @@ class TestPredictor(Base):
         z = net.predict(self.probe)
         self.assert_shape(z.shape, (STEPS, BATCH, INS))
 
+    def test_mask(self):
+        for start in (0, 3):
+            net = self._build(13, mask=True, recurrent_error_start=start)
+            self.assert_masked(net)
+
 
 class TestClassifier(Base):
     def _build(self, *hiddens, **kwargs):
@@ -103,6 +161,20 @@ class TestClassifier(Base):
         z = net.classify(self.probe)
         self.assert_shape(z.shape, (STEPS, BATCH))
 
+    def test_index_input(self):
+        net = theanets.recurrent.Classifier(
+            layers=(7, ('embedding', 5), ('rnn', 4), OUTS), input_type='index')
+        index = np.random.randint(0, 7, size=(STEPS, BATCH)).astype('i')
+        z = net.classify(index)
+        self.assert_shape(z.shape, (STEPS, BATCH))
+
+    def test_mask(self):
+        net = self._build(13, mask=True)
+        assert len(net.inputs) == 3
+        assert net.inputs[-1] is net.mask
+        labels = np.random.randint(OUTS, size=(STEPS, BATCH)).astype('i')
+        self.assert_masked(net, labels)
+
 
 class TestAutoencoder(Base):
     def _build(self, *hiddens, **kwargs):
@@ -121,3 +193,14 @@ class TestAutoencoder(Base):
         net = self._build(13, 14)
         z = net.predict(self.probe)
         self.assert_shape(z.shape, (STEPS, BATCH, INS))
+
+    def test_mask_ones(self):
+        # with or without a mask of ones, the loss sums over variables and
+        # averages over time steps and sequences.
+        mask = np.ones((STEPS, BATCH), 'f')
+        for net, extra in ((self._build(13), ()),
+                           (self._build(13, mask=True), (mask, ))):
+            loss = theano.function(net.inputs, net.loss()[0])
+            err = net.predict(self.probe) - self.probe
+            expected = (err * err).sum(axis=-1).mean()
+            assert np.allclose(loss(self.probe, *extra), expected, rtol=1e-4)
@@ -0,0 +1,123 @@
+import json
+import numpy as np
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import theanets
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # Python 2.x
+    from urllib2 import urlopen
+
+
+class Model:
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, x):
+        self.calls.append(len(x))
+        return 2 * x
+
+    def classify(self, x):
+        return x.argmax(axis=-1)
+
+
+class TestServer:
+    def setUp(self):
+        self.model = Model()
+        self.server = theanets.serve.Server(
+            self.model, max_batch_size=8, max_wait=0.05)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_single(self):
+        assert np.allclose(self.server([1, 2]), [2, 4])
+        assert np.allclose(self.server([[1, 2], [3, 4]]), [[2, 4], [6, 8]])
+
+    def test_batches(self):
+        requests = [self.server.submit([i, 0]) for i in range(20)]
+        for i, request in enumerate(requests):
+            assert np.allclose(request.result(1), [2 * i, 0])
+        assert max(self.model.calls) == 8
+        assert self.server.requests == 20
+        assert self.server.batches == len(self.model.calls) < 20
+
+    def test_classify(self):
+        server = theanets.serve.Server(self.model, method='classify')
+        assert server([0, 3, 1]) == 1
+        server.close()
+
+    def test_error(self):
+        try:
+            self.server.predict(['a', 'b'], timeout=1)
+        except TypeError:
+            pass
+        else:
+            assert False
+        assert np.allclose(self.server([1, 2]), [2, 4])
+
+    def test_error_in_batch(self):
+        model = Model()
+        model.predict = lambda x: np.dot(x, np.eye(2))
+        server = theanets.serve.Server(model, max_batch_size=8, max_wait=0.1)
+        requests = [server.submit([i, 1]) for i in range(3)]
+        bad = server.submit([1, 2, 3])
+        requests.extend(server.submit([i, 2]) for i in range(3))
+        for request in requests:
+            assert request.result(1).shape == (2, )
+        try:
+            bad.result(1)
+        except ValueError:
+            pass
+        else:
+            assert False
+        server.close()
+
+    def test_benchmark(self):
+        report = theanets.serve.benchmark(
+            self.server, np.eye(3), clients=4, requests=40)
+        assert report['throughput'] > 0
+        assert report['max_latency'] >= report['median_latency']
+
+
+class TestFrontends:
+    def setUp(self):
+        self.server = theanets.serve.Server(Model())
+
+    def tearDown(self):
+        self.frontend.shutdown()
+        self.frontend.server_close()
+        self.server.close()
+
+    def start(self, frontend):
+        self.frontend = frontend
+        thread = threading.Thread(target=frontend.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def test_http(self):
+        self.start(theanets.serve.http_frontend(self.server, port=0))
+        url = 'http://127.0.0.1:{}/'.format(self.frontend.server_address[1])
+        body = json.dumps(dict(inputs=[[1, 2]])).encode()
+        response = json.loads(urlopen(url, body).read().decode())
+        assert np.allclose(response['outputs'], [[2, 4]])
+
+    def test_unix(self):
+        path = os.path.join(tempfile.mkdtemp(), 'sock')
+        try:
+            self.start(theanets.serve.unix_frontend(self.server, path))
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            handle = sock.makefile('rwb')
+            for inputs in ([1, 2], [3, 4]):
+                handle.write(json.dumps(dict(inputs=inputs)).encode() + b'\n')
+                handle.flush()
+                response = json.loads(handle.readline().decode())
+                assert np.allclose(response['outputs'], 2 * np.array(inputs))
+            sock.close()
+        finally:
+            shutil.rmtree(os.path.dirname(path))
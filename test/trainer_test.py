@@ -1,8 +1,29 @@
+import numpy as np
+import os
+import shutil
+import tempfile
+import theano
 import theanets
 
 import util
 
 
+class TestMonitorAccumulator:
+    def test_weighted(self):
+        acc = theanets.trainer.MonitorAccumulator(['loss', 'acc'], stats=True)
+        values = np.array([[1., 10.], [2., 20.], [4., 40.]])
+        weights = np.array([32, 32, 8])
+        for v, w in zip(values, weights):
+            acc.add(v, w)
+        monitors = acc.monitors()
+        mean = np.average(values, axis=0, weights=weights)
+        std = np.sqrt(np.average((values - mean) ** 2, axis=0, weights=weights))
+        assert np.allclose([monitors['loss'], monitors['acc']], mean)
+        assert np.allclose([monitors['loss_std'], monitors['acc_std']], std)
+        assert monitors['loss_min'] == 1 and monitors['acc_max'] == 40
+        assert acc.count == 3
+
+
 class TestTrainer(util.MNIST):
     def setUp(self):
         super(TestTrainer, self).setUp()
@@ -18,6 +39,97 @@ class TestTrainer(util.MNIST):
     def test_sgd(self):
         self.assert_progress('sgd', learning_rate=1e-4)
 
+    def test_sgd_resident(self):
+        self.assert_progress('sgd', learning_rate=1e-4, resident=True)
+
+    def test_sgd_resident_cache(self):
+        path = tempfile.mkdtemp()
+        try:
+            self.assert_progress('sgd', learning_rate=1e-4, resident=True,
+                                 function_cache=path)
+            stored = sorted(os.listdir(path))
+            assert stored
+            self.assert_progress('sgd', learning_rate=1e-4, resident=True,
+                                 function_cache=path)
+            assert sorted(os.listdir(path)) == stored
+        finally:
+            shutil.rmtree(path)
+
+    def test_sgd_importance(self):
+        self.assert_progress(
+            'sgd', learning_rate=1e-4, importance_sampling=True)
+
+    def test_sgd_importance_weight(self):
+        # the weight scales gradients after clipping, so clipped gradients are
+        # still corrected.
+        trainer = theanets.trainer.SGD(
+            self.exp.network, max_gradient_norm=1e-3)
+        f = theano.function(self.exp.network.inputs,
+                            list(trainer.clipped_gradients()))
+        unweighted = f(self.images)
+        trainer.batch_weight.set_value(np.cast[theano.config.floatX](3))
+        weighted = f(self.images)
+        for g, w in zip(unweighted, weighted):
+            assert np.allclose(w, 3 * g)
+
+    def test_rmsprop_importance_weight(self):
+        # adaptive trainers apply the weight after normalizing the gradient,
+        # so a weighted first step is the weight times an unweighted one.
+        params = self.exp.network.params
+        initial = [p.get_value() for p in params]
+        steps = []
+        for weight in (1, 3):
+            for p, value in zip(params, initial):
+                p.set_value(value)
+            trainer = theanets.trainer.RmsProp(self.exp.network)
+            trainer.batch_weight.set_value(
+                np.cast[theano.config.floatX](weight))
+            trainer.f_learn(self.images)
+            steps.append([p.get_value() - v for p, v in zip(params, initial)])
+        for one, three in zip(*steps):
+            assert np.allclose(three, 3 * one, rtol=1e-3, atol=1e-6)
+
+    def test_rprop_importance(self):
+        try:
+            self.assert_progress(
+                'rprop', learning_rate=1e-4, importance_sampling=True)
+            assert False
+        except ValueError:
+            pass
+
+    def test_sgd_valid_subset(self):
+        self.assert_progress('sgd', learning_rate=1e-4, valid_subset=100,
+                             valid_confidence=2, validate_every=1)
+
+    def test_validate_early_exit(self):
+        trainer = theanets.trainer.SGD(self.exp.network, valid_confidence=2)
+        dataset = theanets.Dataset(self.images, batch_size=10)
+        f_eval, calls = trainer.f_eval, []
+        def spy(*x):
+            calls.append(x)
+            return f_eval(*x)
+        trainer._f_eval = spy
+        # the loss is far below the target, so validation stops early.
+        trainer._best_loss = 1e6
+        trainer.validate(dataset)
+        assert len(calls) == trainer.valid_min_batches
+        assert len(calls) < len(dataset.batches)
+
+    def test_valid_subset_proportions(self):
+        labels = self.labels.ravel().astype('i')
+        valid = self.exp.create_dataset(
+            (self.images, labels), name='valid', valid_subset=50,
+            shuffle_samples=True)
+        subset = np.concatenate([y for _, y in valid.iterate_fixed()])
+        expected = 50. * np.bincount(labels, minlength=10) / len(labels)
+        assert len(subset) == 50
+        assert (abs(np.bincount(subset, minlength=10) - expected) <= 1).all()
+        # validation samples are never shuffled individually.
+        assert valid._order is None
+
+    def test_sgd_combined(self):
+        self.assert_progress('sgd', learning_rate=1e-4, combine_functions=True)
+
     def test_nag(self):
         self.assert_progress('nag', learning_rate=1e-4)
 
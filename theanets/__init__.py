@@ -1,11 +1,24 @@
 '''This package groups together a bunch of theano code for neural nets.'''
 
-from .dataset import Dataset
-from .main import Experiment
+# the inference engine and server only need numpy, so they can be used to serve
+# trained models on machines without theano.
+from . import engine
+from . import serve
 
-from .feedforward import Network, Autoencoder, Regressor, Classifier
+try:
+    import theano
+except ImportError:
+    theano = None
 
-from . import flags
-from . import layers
-from . import recurrent
-from . import trainer
+if theano is not None:
+    from .dataset import Dataset
+    from .main import Experiment
+
+    from .feedforward import Network, Autoencoder, Regressor, Classifier
+
+    from . import cache
+    from . import flags
+    from . import layers
+    from . import preprocess
+    from . import recurrent
+    from . import trainer
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+r'''This module contains a persistent cache for compiled theano functions.
+
+Compiling the theano functions for a model---the feedforward function of a
+network, plus the evaluation and learning functions of a trainer---can take
+several minutes for large (especially recurrent) models, and this work is
+normally repeated every time a process starts. A :class:`FunctionCache` stores
+compiled functions on disk, so that later processes that build the same
+computation graph can load the compiled function instead.
+
+Cached functions are keyed on a fingerprint of the computation graph they
+compute (which covers the network topology, activations, and constants such as
+learning rates), a caller-supplied key (e.g., the trainer class and function
+name), and the theano configuration that affects compilation. When a function
+is loaded, the shared variables it was compiled with are swapped for the shared
+variables in the current graph, so the loaded function operates on the current
+model parameters.
+
+To use a cache, pass a directory as the ``function_cache`` keyword argument to a
+network or trainer, or use the ``--function-cache`` command-line flag::
+
+  exp = theanets.Experiment(
+      theanets.recurrent.Regressor, layers=(3, ('lstm', 10), 3),
+      function_cache='/tmp/theanets-functions')
+'''
+
+import climate
+import hashlib
+import numpy as np
+import os
+import pickle
+import sys
+import tempfile
+import theano
+
+logging = climate.get_logger(__name__)
+
+# theano configuration values that affect compiled functions.
+CONFIG_KEYS = ('floatX', 'device', 'mode', 'linker', 'optimizer',
+               'optimizer_including', 'optimizer_excluding', 'cast_policy')
+
+
+def _shared_variables(variables):
+    '''Get the shared variables in a graph, in a deterministic order.'''
+    shared = []
+    for var in theano.gof.graph.inputs(variables):
+        if isinstance(var, theano.compile.SharedVariable) and \
+                not any(var is s for s in shared):
+            shared.append(var)
+    return shared
+
+
+class FunctionCache(object):
+    '''A directory of compiled theano functions.
+
+    Parameters
+    ----------
+    path : str
+        Directory where compiled functions are stored. It is created if needed.
+    max_size : int, optional
+        Maximum total size of stored functions, in bytes. When a new function
+        is stored, the least recently used functions are removed until the
+        cache fits. Defaults to 1 GB.
+    '''
+
+    def __init__(self, path, max_size=1 << 30):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def fingerprint(self, inputs, outputs, updates=(), givens=(), key=()):
+        '''Compute a string key for a function.
+
+        Parameters
+        ----------
+        inputs : list of theano variables
+            Explicit inputs of the function.
+        outputs : list of theano expressions
+            Outputs of the function.
+        updates : list of update tuples, optional
+            Updates performed by the function.
+        givens : list of (variable, expression) tuples, optional
+            Substitutions made in the graph of the function.
+        key : tuple, optional
+            Additional values that distinguish the function.
+
+        Returns
+        -------
+        fingerprint : str
+            A hash of the function graph (including the values of constants),
+            key, and theano configuration.
+        '''
+        def add(s):
+            h.update(str(s).encode('utf-8'))
+        if isinstance(givens, dict):
+            givens = givens.items()
+        h = hashlib.sha1()
+        add(key)
+        add(theano.__version__)
+        for name in CONFIG_KEYS:
+            add(getattr(theano.config, name, None))
+        add([(v.name, v.type) for v in inputs])
+        graph = list(outputs)
+        for var, expr in list(updates) + list(givens):
+            graph.extend([var, expr])
+        add(theano.printing.debugprint(graph, file='str', print_type=True))
+        # printed graphs abbreviate large constants (e.g., the arrays of an
+        # input transform), so hash the values of constants separately.
+        for var in theano.gof.graph.ancestors(graph):
+            if isinstance(var, theano.gof.Constant):
+                data = np.asarray(var.data)
+                add((data.dtype, data.shape))
+                if data.dtype == object:
+                    add(var.data)
+                else:
+                    h.update(np.ascontiguousarray(data).tobytes())
+        return h.hexdigest()
+
+    def function(self, inputs, outputs, updates=(), givens=(), key=(),
+                 **kwargs):
+        '''Load a compiled function from the cache, or compile and store it.
+
+        Parameters
+        ----------
+        inputs : list of theano variables
+            Explicit inputs of the function.
+        outputs : list of theano expressions
+            Outputs of the function.
+        updates : list of update tuples, optional
+            Updates performed by the function.
+        givens : list of (variable, expression) tuples, optional
+            Substitutions made in the graph of the function.
+        key : tuple, optional
+            Additional values that distinguish the function (e.g., the name
+            of the function and the class of the trainer that uses it).
+
+        Other keyword arguments are passed to ``theano.function``.
+
+        Returns
+        -------
+        function : theano function
+            A compiled function that operates on the shared variables in the
+            given graph.
+        '''
+        if isinstance(givens, dict):
+            givens = givens.items()
+        updates, givens = list(updates), list(givens)
+        graph = list(outputs) + [e for _, e in givens]
+        for var, expr in updates:
+            graph.extend([var, expr])
+        shared = _shared_variables(graph)
+        filename = os.path.join(self.path, '{}.pkl'.format(
+            self.fingerprint(inputs, outputs, updates, givens, key)))
+
+        if os.path.exists(filename):
+            try:
+                function = self._load(filename, shared)
+                os.utime(filename, None)  # mark as recently used.
+                logging.info('%s: loaded compiled function', filename)
+                return function
+            except Exception:
+                logging.warning('%s: cannot load compiled function: %s',
+                                filename, sys.exc_info()[1])
+
+        function = theano.function(
+            inputs, outputs, updates=updates, givens=givens, **kwargs)
+        try:
+            self._save(filename, function, shared)
+            self.evict()
+        except Exception:
+            logging.warning('%s: cannot store compiled function: %s',
+                            filename, sys.exc_info()[1])
+        return function
+
+    def _load(self, filename, shared):
+        '''Load a function and swap in the given shared variables.'''
+        # unpickling would otherwise re-run the graph optimizer if theano is
+        # configured to, which costs most of the time the cache saves.
+        key = 'reoptimize_unpickled_function'
+        reoptimize = getattr(theano.config, key, None)
+        if reoptimize is not None:
+            setattr(theano.config, key, False)
+        try:
+            with open(filename, 'rb') as handle:
+                stored = pickle.load(handle)
+        finally:
+            if reoptimize is not None:
+                setattr(theano.config, key, reoptimize)
+        function, positions = stored['function'], stored['shared']
+        implicit = [i.variable for i in function.maker.inputs if i.implicit]
+        if len(implicit) != len(positions) or \
+                max(positions + [-1]) >= len(shared):
+            raise ValueError('shared variables do not match graph')
+        swap = dict((old, shared[j]) for old, j in zip(implicit, positions))
+        return function.copy(swap=swap, name=function.name)
+
+    def _save(self, filename, function, shared):
+        '''Store a function, along with the positions of its shared inputs.'''
+        positions = []
+        for i in function.maker.inputs:
+            if i.implicit:
+                positions.append(
+                    [j for j, s in enumerate(shared) if s is i.variable][0])
+        handle = tempfile.NamedTemporaryFile(dir=self.path, delete=False)
+        try:
+            pickle.dump(dict(function=function, shared=positions), handle, -1)
+            handle.close()
+            os.rename(handle.name, filename)
+        except Exception:
+            handle.close()
+            os.unlink(handle.name)
+            raise
+        logging.info('%s: stored compiled function', filename)
+
+    def evict(self):
+        '''Remove least recently used functions until the cache fits.'''
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_size:
+                break
+            os.unlink(os.path.join(self.path, name))
+            logging.info('%s: evicted compiled function', name)
+            total -= size
+
+
+def function(inputs, outputs, cache=None, key=(), max_size=1 << 30, **kwargs):
+    '''Compile a theano function, using a function cache if one is given.
+
+    Parameters
+    ----------
+    inputs : list of theano variables
+        Explicit inputs of the function.
+    outputs : list of theano expressions
+        Outputs of the function.
+    cache : str or :class:`FunctionCache`, optional
+        A function cache, or the path of its directory. Defaults to None, which
+        compiles the function without caching it.
+    key : tuple, optional
+        Additional values that distinguish the function in the cache.
+    max_size : int, optional
+        Maximum size of the cache in bytes, if `cache` is a path. Defaults to
+        1 GB.
+
+    Other keyword arguments (e.g., ``updates`` or ``givens``) are passed to
+    ``theano.function``.
+
+    Returns
+    -------
+    function : theano function
+        A compiled function.
+    '''
+    if not cache:
+        return theano.function(inputs, outputs, **kwargs)
+    if not isinstance(cache, FunctionCache):
+        cache = FunctionCache(cache, max_size)
+    return cache.function(inputs, outputs, key=key, **kwargs)
@@ -26,9 +26,27 @@ representations of data, then your dataset will only require the input samples.
     ``theanets`` documentation assumes row vectors and row-oriented matrices.
 '''
 
+import atexit
 import climate
 import collections
+import hashlib
+import json
+import multiprocessing
+import numpy as np
 import numpy.random as rng
+import os
+import scipy.sparse
+import signal
+import sys
+import theano
+import theano.tensor as TT
+import threading
+import traceback
+
+try:
+    import queue
+except ImportError:  # Python 2.x
+    import Queue as queue
 
 logging = climate.get_logger(__name__)
 
@@ -58,6 +76,16 @@ class Dataset:
     your task, pass a second ``numpy`` array of label data; the two arrays
     should have the same size along their first axis.
 
+    Datasets that are too large to fit in memory can be stored on disk as
+    ``.npy`` files and passed to this class either as filenames or as
+    ``np.memmap`` arrays. In this case, the dataset only keeps a table of batch
+    offsets in memory, and mini-batches are read lazily from disk as views into
+    the memory-mapped data.
+
+    Sparse sample data can be passed as a ``scipy.sparse`` matrix; rows of the
+    matrix are sliced into mini-batches in compressed sparse row format, for
+    use with networks created with ``input_type='sparse'``.
+
     There are some cases (especially when training recurrent networks) when a
     suitable set of training data would be prohibitively expensive to assemble
     in memory as a single ``numpy`` array. To handle these cases, this class can
@@ -67,22 +95,27 @@ class Dataset:
 
     Parameters
     ----------
-    samples : ndarray or callable
+    samples : ndarray, sparse matrix, str, or callable
         A set of samples from some data distribution.
 
         If this parameter is not callable, it is expected to be an ndarray
         containing the "unlabeled" sample data to be used during training,
-        validation, etc.
+        validation, etc. If this is a string, it is treated as the path to a
+        ``.npy`` file that will be memory-mapped. If this is a sparse matrix,
+        mini-batches are sparse matrices containing rows of the samples.
 
         If this parameter is callable, then mini-batches will be obtained by
         calling the callable with no arguments; the callable is expected to
         return a tuple of ndarrays that will be suitable for training a network.
+        If `keys` are given, the callable is instead called with one key as
+        its argument, and should always return the same batch for a given key.
 
-    labels : ndarray, optional
+    labels : ndarray or str, optional
         A set of labels corresponding to the sample data. The labels array, if
         present, is expected to have the same number of elements along the
-        splitting axis as the samples array. This parameter is ignored if
-        `samples` is callable.
+        splitting axis as the samples array. If this is a string, it is treated
+        as the path to a ``.npy`` file that will be memory-mapped. This
+        parameter is ignored if `samples` is callable.
 
     name : str, optional
         A string that is used to describe this dataset. Usually something like
@@ -102,18 +135,118 @@ class Dataset:
         The axis along which to split the samples and labels. If not provided,
         defaults to 0 (first axis) for 2-dimensional datasets, and to 1 (second
         axis) for 3-dimensional datasets (e.g., for recurrent networks).
+
+    shuffle_samples : bool, optional
+        If True, draw a fresh permutation of the individual samples every time
+        the dataset is shuffled, so that the composition of each mini-batch
+        changes from one pass through the data to the next. Mini-batches are
+        gathered into preallocated buffers that are reused across batches, so
+        a batch is only valid until the next one is requested. Defaults to
+        False, which cuts the data into fixed mini-batches and only shuffles
+        the order in which these batches are visited.
+
+    prefetch : int, optional
+        If positive, prepare up to this many mini-batches ahead of time in
+        background threads, so that loading or generating data overlaps with
+        computations on the current batch. Defaults to 0, which prepares each
+        batch only when it is requested.
+
+    prefetch_threads : int, optional
+        Number of background threads to use for prefetching. Several threads
+        can call a callable dataset at the same time (so the callable must be
+        thread-safe); batches of array data are always prepared in order by a
+        single thread. Defaults to 1.
+
+    workers : int, optional
+        If positive and `samples` is callable, call it in this many worker
+        processes (see :class:`WorkerPool`) instead of in the training process.
+        The callable must return batches whose shapes and dtypes do not change
+        from call to call. Defaults to 0, which calls it in the training
+        process.
+
+    resident : bool, optional
+        If True, copy array data once into Theano shared variables (i.e., onto
+        the GPU, if one is in use). Trainers then compile functions that take
+        the offsets of a mini-batch and slice it out of the shared data inside
+        the computation graph, instead of copying each batch from host memory.
+        Defaults to False.
+
+    quantize : str, optional
+        If given, store array samples in memory using this reduced-precision
+        dtype, either 'uint8' or 'float16', together with a scale and offset for
+        each column (i.e., each index along the last axis) of the samples.
+        Mini-batches are converted back to ``theano.config.floatX`` as they are
+        produced, in buffers that are reused across batches (or inside the
+        computation graph, for resident datasets). Labels are stored unchanged.
+        Defaults to None, which stores samples as given.
+
+    rng : int or numpy RandomState, optional
+        A random number generator, or an integer seed for one, to use for
+        shuffling this dataset. Together with :func:`get_state` and
+        :func:`set_state`, this makes the order of mini-batches reproducible
+        across runs. Defaults to a generator seeded from the global ``numpy``
+        random state.
+
+    transform : callable, optional
+        A function to apply to the samples (i.e., the first array) of each
+        mini-batch as it is produced, for example an :class:`Affine
+        <theanets.preprocess.Affine>` normalization computed by
+        :class:`theanets.preprocess.Statistics`. For resident datasets, the
+        transform is applied inside the computation graph, so it must also
+        accept theano expressions. Defaults to None.
+
+    keys : sequence, optional
+        If given, `samples` must be a callable that takes one of these keys as
+        an argument and returns the mini-batch for that key. The keys are then
+        shuffled and iterated over like the mini-batches of an array dataset,
+        so the callable is called once per key in each pass through the data.
+        Keys must be hashable. Defaults to None.
+
+    cache_size : int, optional
+        If positive and `keys` are given, keep up to this many mini-batches
+        returned by the callable in memory (see :class:`BatchCache`), so that
+        later passes through the data reuse them instead of calling the
+        callable again. Defaults to 0, which does not cache batches.
+
+    cache_dir : str, optional
+        If given along with `keys`, save mini-batches that are evicted from the
+        in-memory cache to ``.npz`` files in this directory, and load them from
+        there when they are next needed. Defaults to None.
     '''
 
     def __init__(self, samples, labels=None, name=None, batch_size=32,
-                 iteration_size=None, axis=None):
+                 iteration_size=None, axis=None, shuffle_samples=False,
+                 prefetch=0, prefetch_threads=1, workers=0, resident=False,
+                 quantize=None, rng=None, transform=None, keys=None,
+                 cache_size=0, cache_dir=None):
         '''Create a minibatch dataset from data arrays or a callable.'''
         self.name = name or 'dataset'
         self.batch_size = batch_size
         self.iteration_size = iteration_size
+        self.shuffle_samples = shuffle_samples
+        self.prefetch = prefetch
+        self.prefetch_threads = prefetch_threads
+        self.workers = workers
+        self.resident = resident
+        self.quantize = quantize
+        if not isinstance(rng, np.random.RandomState):
+            if rng is None:
+                rng = np.random.randint(1 << 30)
+            rng = np.random.RandomState(rng)
+        self.rng = rng
+        self.transform = transform
+        self.keys = keys
 
         self.batches = []
+        self._pool = None
+        self._cache = None
+        self._index = 0  # index for iteration.
+        self._perm = None  # original positions of batches, if any.
+        self._order = self._shared_order = None  # order of samples, if any.
 
-        if isinstance(samples, collections.Callable):
+        if isinstance(samples, collections.Callable) and keys is not None:
+            self._init_keys(samples, cache_size, cache_dir)
+        elif isinstance(samples, collections.Callable):
             self._init_callable(samples)
         else:
             self._init_arrays(samples, labels, axis)
@@ -124,6 +257,7 @@ class Dataset:
 
     def _init_callable(self, samples):
         self.batches = samples
+        self.resident = False  # only array data can be made resident.
         if not self.iteration_size:
             try:
                 self.iteration_size = len(samples)
@@ -132,43 +266,337 @@ class Dataset:
         logging.info('%s: %d mini-batches from callable',
                      self.name, self.iteration_size)
 
+    def _init_keys(self, samples, cache_size, cache_dir):
+        self.batches = list(self.keys)
+        self.resident = False
+        self._cache = BatchCache(samples, cache_size, cache_dir)
+        self._perm = np.arange(len(self.batches))
+        self.shuffle()
+        if not self.iteration_size:
+            self.iteration_size = len(self.batches)
+        logging.info('%s: %d of %d keyed mini-batches from callable%s',
+                     self.name, self.iteration_size, len(self.batches),
+                     ' (cached)' if cache_size > 0 or cache_dir else '')
+
     def _init_arrays(self, samples, labels, axis):
-        self._index = 0  # index for iteration.
+        if isinstance(samples, str):
+            samples = np.load(samples, mmap_mode='r')
+        if isinstance(labels, str):
+            labels = np.load(labels, mmap_mode='r')
 
         if axis is None:
             axis = 1 if len(samples.shape) == 3 else 0
-        slices = [slice(None), slice(None)][:axis + 1]
+        self._axis = axis
+        self._arrays = [samples]
+        if labels is not None:
+            self._arrays.append(labels)
+
+        # sparse samples are kept in compressed row format, which can only be
+        # sliced along rows, and are never made resident on the device.
+        sparse = scipy.sparse.issparse(samples)
+        if sparse:
+            self._arrays[0] = samples.tocsr()
+            self.resident = False
+
+        self._scale = self._offset = None
+        if self.quantize:
+            if sparse:
+                raise ValueError(
+                    '{}: sparse samples cannot be quantized'.format(self.name))
+            self._arrays[0] = self._quantize(samples)
+
+        # memory-mapped arrays are sliced lazily, so for these we only keep a
+        # table of batch offsets in memory. the same goes for datasets that
+        # gather batches through a permutation of the samples, and for sparse
+        # arrays, whose slices are copies rather than views, and for quantized
+        # arrays, which are converted to floats one batch at a time.
+        self._order = None
+        self._buffers = {}
+        if self.shuffle_samples:
+            self._order = np.arange(samples.shape[axis])
+        mapped = any(isinstance(a, np.memmap) for a in self._arrays)
+        self._lazy = (mapped or sparse or self.resident or
+                      self._scale is not None or self._order is not None)
+        # trainers use this to weigh the last (possibly short) mini-batch.
+        self.number_samples = samples.shape[axis]
         for i in range(0, samples.shape[axis], self.batch_size):
-            slices[axis] = slice(i, i + self.batch_size)
-            batch = [samples[tuple(slices)]]
-            if labels is not None:
-                batch.append(labels[tuple(slices)])
-            self.batches.append(batch)
+            index = slice(i, i + self.batch_size)
+            self.batches.append(index if self._lazy else self._slice(index))
+        self._perm = np.arange(len(self.batches))
+
+        self._shared = self._shared_order = None
+        if self.resident:
+            self._shared = [
+                theano.shared(np.asarray(a), name='{}_{}'.format(self.name, i),
+                              borrow=True)
+                for i, a in enumerate(self._arrays)]
+            if self._order is not None:
+                self._shared_order = theano.shared(
+                    self._order, name='{}_order'.format(self.name))
         self.shuffle()
 
         if not self.iteration_size:
             self.iteration_size = len(self.batches)
 
-        shapes = str(self.batches[0][0].shape)
+        batch = self._batch(self.batches[0])
+        shapes = str(batch[0].shape)
         if labels is not None:
-            x, y = self.batches[0]
-            shapes = '{} -> {}'.format(x.shape, y.shape)
-        logging.info('%s: %d of %d mini-batches of %s',
-                     self.name, self.iteration_size,
-                     len(self.batches), shapes)
+            shapes = '{} -> {}'.format(batch[0].shape, batch[1].shape)
+        notes = (('memory-mapped', mapped), ('sparse', sparse),
+                 (self.quantize, self._scale is not None))
+        logging.info('%s: %d of %d mini-batches of %s%s',
+                     self.name, self.iteration_size, len(self.batches), shapes,
+                     ''.join(' ({})'.format(n) for n, on in notes if on))
+
+    def _quantize(self, samples, chunk=1024):
+        '''Convert samples to our reduced-precision storage dtype.
+
+        Parameters
+        ----------
+        samples : ndarray
+            An array of sample data.
+        chunk : int, optional
+            Convert this many elements along the first axis of the samples at a
+            time, to limit the size of temporary arrays. Defaults to 1024.
+
+        Returns
+        -------
+        quantized : ndarray
+            An array of quantized samples. The scale and offset for recovering
+            the original values are stored in this dataset.
+        '''
+        dtype = np.dtype(self.quantize)
+        axes = tuple(range(samples.ndim - 1))
+        lo = samples.min(axis=axes).astype(np.float64)
+        hi = samples.max(axis=axes).astype(np.float64)
+        levels = np.iinfo(dtype).max if dtype.kind in 'iu' else 1
+        scale = (hi - lo) / levels
+        scale[scale == 0] = 1
+        quantized = np.empty(samples.shape, dtype)
+        for i in range(0, len(samples), chunk):
+            values = (samples[i:i + chunk] - lo) / scale
+            if dtype.kind in 'iu':
+                values = np.round(values)
+            quantized[i:i + chunk] = values
+        self._scale = scale.astype(theano.config.floatX)
+        self._offset = lo.astype(theano.config.floatX)
+        return quantized
+
+    def _dequantize(self, arr):
+        '''Convert a batch of quantized samples to floats in a reused buffer.'''
+        out = self._buffer(('float', arr.shape), arr.shape, self._scale.dtype)
+        np.multiply(arr, self._scale, out=out)
+        out += self._offset
+        return out
+
+    def _slice(self, index):
+        '''Get views of our data arrays for a slice along the batch axis.'''
+        slices = [slice(None), slice(None)][:self._axis + 1]
+        slices[self._axis] = index
+        return [a[index] if scipy.sparse.issparse(a) else a[tuple(slices)]
+                for a in self._arrays]
+
+    def _buffer(self, key, shape, dtype):
+        '''Get the next buffer from a ring of reusable batch buffers.'''
+        if key not in self._buffers:
+            # while prefetching, the batch being used, the batches waiting in
+            # the queue, and the batch being prepared need their own buffers.
+            ring = self.prefetch + 2 if self.prefetch > 0 else 1
+            self._buffers[key] = collections.deque(
+                np.empty(shape, dtype) for _ in range(ring))
+        buffers = self._buffers[key]
+        buffers.rotate(1)
+        return buffers[0]
+
+    def _gather(self, index):
+        '''Gather samples at the given indices into reusable batch buffers.'''
+        batch = []
+        for i, arr in enumerate(self._arrays):
+            if scipy.sparse.issparse(arr):
+                batch.append(arr[index])
+                continue
+            shape = list(arr.shape)
+            shape[self._axis] = len(index)
+            out = self._buffer((i, len(index)), shape, arr.dtype)
+            batch.append(np.take(arr, index, axis=self._axis,
+                                 out=out, mode='clip'))
+        return batch
+
+    def _batch(self, entry, fixed=False):
+        '''Get the arrays for one mini-batch, given its entry in our table.
+
+        If `fixed` is True, samples are taken in their original order, even if
+        the samples are shuffled individually.
+        '''
+        if self._cache is not None:
+            return self._cache(entry)
+        if not self._lazy:
+            return entry
+        if self._order is not None and not fixed:
+            batch = self._gather(self._order[entry])
+        else:
+            batch = self._slice(entry)
+        if self._scale is not None:
+            batch[0] = self._dequantize(batch[0])
+        return batch
 
     def __iter__(self):
         return self.iterate(True)
 
     def shuffle(self):
-        rng.shuffle(self.batches)
+        if self._order is not None:
+            self.rng.shuffle(self._order)
+            if self._shared_order is not None:
+                self._shared_order.set_value(self._order)
+        perm = self.rng.permutation(len(self.batches))
+        self.batches = [self.batches[i] for i in perm]
+        self._perm = self._perm[perm]
+
+    def get_state(self):
+        '''Get the state of iteration through this dataset.
+
+        Returns
+        -------
+        state : dict
+            A dictionary containing the state of our random number generator,
+            the current order of mini-batches (and of samples, if these are
+            shuffled individually), and the position of the most recent
+            mini-batch in that order.
+        '''
+        state = dict(rng=self.rng.get_state(), index=self._index)
+        if self._perm is not None:
+            state['perm'] = self._perm.copy()
+        if self._order is not None:
+            state['order'] = self._order.copy()
+        return state
+
+    def set_state(self, state):
+        '''Restore a state of iteration through this dataset.
+
+        Iteration will continue with the mini-batch after the one that was most
+        recent when the state was captured, and subsequent shuffles will happen
+        exactly as they would have in the original dataset.
+
+        Parameters
+        ----------
+        state : dict
+            A dictionary of state information, as returned by
+            :func:`get_state` on a dataset containing the same data.
+        '''
+        self.rng.set_state(state['rng'])
+        self._index = state['index']
+        if 'perm' in state:
+            original = [None] * len(self.batches)
+            for i, batch in zip(self._perm, self.batches):
+                original[i] = batch
+            self._perm = np.array(state['perm'])
+            self.batches = [original[i] for i in self._perm]
+        if 'order' in state:
+            self._order[:] = state['order']
+            if self._shared_order is not None:
+                self._shared_order.set_value(self._order)
+
+    def givens(self, inputs, start, stop, fixed=False):
+        '''Get expressions that slice a mini-batch out of resident data.
+
+        Parameters
+        ----------
+        inputs : sequence of theano variables
+            The input variables of a network; these will be replaced by
+            mini-batches of our samples (and labels, if any).
+        start : theano scalar
+            Offset of the first element of the mini-batch.
+        stop : theano scalar
+            Offset past the last element of the mini-batch.
+        fixed : bool, optional
+            If True, slice samples in their original order, even if samples
+            are shuffled individually (see :func:`iterate_fixed`). Defaults to
+            False.
+
+        Returns
+        -------
+        givens : list of (variable, expression) pairs
+            A list suitable for the `givens` argument of ``theano.function``.
+        '''
+        assert self._shared, '{} is not a resident dataset'.format(self.name)
+        index = slice(start, stop)
+        if self._shared_order is not None and not fixed:
+            index = self._shared_order[start:stop]
+        index = (slice(None), ) * self._axis + (index, )
+        givens = []
+        for i, (var, data) in enumerate(zip(inputs, self._shared)):
+            expr = data[index]
+            if i == 0 and self._scale is not None:
+                expr = TT.cast(expr, self._scale.dtype) * self._scale
+                expr = expr + self._offset
+            if i == 0 and self.transform is not None:
+                expr = self.transform(expr)
+            givens.append((var, TT.cast(expr, var.dtype)))
+        return givens
 
     def iterate(self, update=True):
+        if callable(self.batches) and self.workers > 0:
+            return self._iter_workers()
+        if self.prefetch > 0:
+            return self._iter_prefetch(update)
         return self._iter_callable() \
             if callable(self.batches) \
             else self._iter_batches(update)
 
-    def _iter_batches(self, update=True):
+    def _iter_prefetch(self, update=True):
+        '''Yield mini-batches that are prepared in background threads.'''
+        threads = 1
+        source = self._iter_batches(update)
+        if callable(self.batches):
+            # each thread calls our callable directly, so here the source just
+            # counts off the number of batches to produce.
+            threads = max(1, self.prefetch_threads)
+            source = iter(range(self.iteration_size))
+
+        batches = queue.Queue(maxsize=self.prefetch)
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    return batches.put(item, timeout=0.1)
+                except queue.Full:
+                    pass
+
+        def work():
+            try:
+                while not stop.is_set():
+                    with lock:
+                        batch = next(source, None)
+                    if batch is None:
+                        break
+                    if callable(self.batches):
+                        batch = self._apply_transform(self.batches())
+                    put((batch, None))
+            except Exception:
+                put((None, sys.exc_info()[1]))
+            put(None)
+
+        workers = [threading.Thread(target=work) for _ in range(threads)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            finished = 0
+            while finished < threads:
+                item = batches.get()
+                if item is None:
+                    finished += 1
+                    continue
+                batch, error = item
+                if error is not None:
+                    raise error
+                yield batch
+        finally:
+            stop.set()
+
+    def _iter_entries(self, update=True):
         k = len(self.batches)
         for _ in range(self.iteration_size):
             self._index += 1
@@ -176,11 +604,781 @@ class Dataset:
         if update:
             self.update()
 
+    def _iter_batches(self, update=True):
+        for entry in self._iter_entries(update):
+            yield self._apply_transform(self._batch(entry))
+
+    def _apply_transform(self, batch):
+        '''Apply our transform, if any, to the samples in a mini-batch.'''
+        if self.transform is None:
+            return batch
+        batch = list(batch)
+        batch[0] = self.transform(batch[0])
+        return batch
+
+    def iterate_offsets(self, update=True):
+        '''Iterate over the offsets of mini-batches in a resident dataset.
+
+        Yields
+        ------
+        start : int
+            Offset of the first element of a mini-batch.
+        stop : int
+            Offset past the last element of the mini-batch.
+        '''
+        for entry in self._iter_entries(update):
+            yield entry.start, entry.stop
+
+    def iterate_fixed(self, offsets=False):
+        '''Iterate once over mini-batches in a fixed order.
+
+        Mini-batches are visited in the order in which they were originally
+        cut from the data, and contain the samples they were originally cut
+        from, no matter how the dataset (or, with `shuffle_samples`, the order
+        of its samples) has been shuffled. Iterating this way neither advances
+        nor shuffles the dataset. This makes repeated passes (e.g., for
+        validation) directly comparable, even if they are cut short. Datasets
+        without a fixed table of mini-batches (e.g., callables) are iterated as
+        usual, without shuffling.
+
+        Parameters
+        ----------
+        offsets : bool, optional
+            If True, yield the (start, stop) offsets of mini-batches in a
+            resident dataset, as in :func:`iterate_offsets`, instead of the
+            mini-batches themselves. Offsets refer to the original order of
+            samples, so they must be used with ``givens(..., fixed=True)``.
+            Defaults to False.
+
+        Yields
+        ------
+        batch : list of ndarray or (int, int)
+            A mini-batch of data, or the offsets of one.
+        '''
+        if callable(self.batches) or self._perm is None:
+            return self.iterate_offsets(False) if offsets else \
+                self.iterate(False)
+        entries = [self.batches[i] for i in np.argsort(self._perm)]
+        entries = entries[:self.iteration_size]
+        if offsets:
+            return ((e.start, e.stop) for e in entries)
+        return (self._apply_transform(self._batch(e, fixed=True))
+                for e in entries)
+
     def _iter_callable(self):
         for _ in range(self.iteration_size):
-            yield self.batches()
+            yield self._apply_transform(self.batches())
+
+    def _iter_workers(self):
+        '''Yield mini-batches generated by a pool of worker processes.'''
+        if self._pool is None:
+            self._pool = WorkerPool(self.batches, self.workers,
+                                    seed=self.rng.randint(1 << 30))
+        try:
+            for batch in self._pool.iterate(self.iteration_size):
+                yield self._apply_transform(batch)
+        except KeyboardInterrupt:
+            self.close()
+            raise
+
+    def close(self):
+        '''Release background resources (e.g., worker processes), if any.'''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
 
     def update(self):
         if self._index >= len(self.batches):
             self.shuffle()
             self._index = 0
+
+
+class SequenceDataset(Dataset):
+    '''A dataset of variable-length sequences, batched by sequence length.
+
+    Recurrent networks process mini-batches of sequences that all have the same
+    number of time steps, so sequences of different lengths must be padded to
+    the length of the longest sequence in their mini-batch. To avoid wasting
+    most of the computation on padding, this dataset sorts sequences by length
+    and groups sequences of similar length together into mini-batches
+    ("buckets"). Sequences of equal length are grouped randomly, and the
+    grouping is redrawn whenever the dataset is shuffled.
+
+    Each mini-batch is a list containing the padded samples, the padded labels
+    (if any), and a (time-steps, batch-size) mask array that is 1 for steps that
+    contain data and 0 for steps that contain padding. This matches the inputs
+    of recurrent networks that are created with ``mask=True``.
+
+    Parameters
+    ----------
+    samples : sequence of ndarray
+        A list of sequences. Each sequence is an array whose first axis indexes
+        time steps; sequences may differ in length but must otherwise have the
+        same shape.
+    labels : sequence of ndarray, optional
+        A list of label sequences, one for each sample sequence, having the same
+        number of time steps as the corresponding sample.
+
+    Other keyword arguments are the same as for :class:`Dataset`.
+    '''
+
+    def _init_arrays(self, samples, labels, axis):
+        self._samples = samples
+        self._labels = labels
+        self._lengths = np.array([len(s) for s in samples])
+        self.resident = False  # sequences are padded as they are iterated.
+        self.shuffle()
+
+        if not self.iteration_size:
+            self.iteration_size = len(self.batches)
+
+        logging.info('%s: %d of %d mini-batches of %d sequences, %d-%d steps',
+                     self.name, self.iteration_size, len(self.batches),
+                     len(samples), self._lengths.min(), self._lengths.max())
+
+    def shuffle(self):
+        # sort by length, breaking ties randomly, then cut into mini-batches.
+        order = np.lexsort((self.rng.random_sample(len(self._lengths)),
+                            self._lengths))
+        self.batches = [order[i:i + self.batch_size]
+                        for i in range(0, len(order), self.batch_size)]
+        self.rng.shuffle(self.batches)
+
+    def get_state(self):
+        state = Dataset.get_state(self)
+        state['batches'] = [b.copy() for b in self.batches]
+        return state
+
+    def set_state(self, state):
+        Dataset.set_state(self, state)
+        self.batches = [np.array(b) for b in state['batches']]
+
+    def _pad(self, sequences, steps):
+        '''Pad a group of sequences into one (time-steps, batch, ...) array.'''
+        first = np.asarray(sequences[0])
+        arr = np.zeros((steps, len(sequences)) + first.shape[1:], first.dtype)
+        for i, seq in enumerate(sequences):
+            arr[:len(seq), i] = seq
+        return arr
+
+    def _batch(self, entry):
+        lengths = self._lengths[entry]
+        steps = lengths.max()
+        batch = [self._pad([self._samples[i] for i in entry], steps)]
+        if self._labels is not None:
+            batch.append(self._pad([self._labels[i] for i in entry], steps))
+        mask = np.arange(steps)[:, None] < lengths[None, :]
+        batch.append(mask.astype(theano.config.floatX))
+        return batch
+
+
+class ImportanceDataset(Dataset):
+    '''A dataset that visits mini-batches in proportion to their recent loss.
+
+    Once a model has learned to handle some part of a dataset, mini-batches
+    from that part contribute little to further training. This dataset keeps
+    an estimate of the loss of each of its mini-batches, which a trainer reports
+    through :func:`observe` after each training step, and draws mini-batches
+    with probability proportional to these estimates, mixed with a uniform
+    distribution so that every batch is revisited now and then. Batches that
+    have not been observed yet are assigned the largest observed loss, so they
+    are visited early.
+
+    To keep the expected gradient unbiased, each mini-batch comes with a
+    correction weight :math:`1 / (k p_i)` for a batch drawn with probability
+    :math:`p_i` out of :math:`k` batches; this is available in the ``weight``
+    attribute while the batch is in use. :class:`SGD <theanets.trainer.SGD>`
+    and its subclasses scale their gradients by this weight.
+
+    Importance sampling works on fixed mini-batches of array data, so this
+    dataset cannot be created from a callable or with ``shuffle_samples``, and
+    it does not prefetch batches (the weight must match the batch in use).
+
+    Parameters
+    ----------
+    smoothing : float in [0, 1), optional
+        Blend each new loss observation for a batch with its previous estimate
+        using this weight for the previous estimate. Defaults to 0, which keeps
+        only the most recent observation.
+    uniform : float in (0, 1], optional
+        Fraction of the sampling distribution that is uniform over batches. This
+        bounds correction weights by ``1 / uniform``. Defaults to 0.1.
+
+    Other keyword arguments are the same as for :class:`Dataset`.
+
+    Attributes
+    ----------
+    weight : float
+        The correction weight for the most recent mini-batch.
+    '''
+
+    def __init__(self, samples, labels=None, smoothing=0., uniform=0.1,
+                 **kwargs):
+        self.smoothing = smoothing
+        self.uniform = uniform
+        self.weight = 1.
+        Dataset.__init__(self, samples, labels=labels, **kwargs)
+
+    def _init_callable(self, samples):
+        raise ValueError('{}: importance sampling needs array data, not a '
+                         'callable'.format(self.name))
+
+    def _init_arrays(self, samples, labels, axis):
+        if self.shuffle_samples:
+            raise ValueError('{}: importance sampling tracks fixed mini-'
+                             'batches, so samples cannot be shuffled'
+                             .format(self.name))
+        if self.prefetch > 0:
+            logging.info('%s: not prefetching importance-sampled batches',
+                         self.name)
+            self.prefetch = 0
+        Dataset._init_arrays(self, samples, labels, axis)
+        self._losses = np.zeros(len(self.batches))
+        self._seen = np.zeros(len(self.batches), bool)
+        self._current = None
+
+    def shuffle(self):
+        pass  # batches are drawn at random, so their order is fixed.
+
+    def probabilities(self):
+        '''Get the probability of drawing each mini-batch next.
+
+        Returns
+        -------
+        probs : ndarray
+            An array containing one probability for each mini-batch.
+        '''
+        k = len(self.batches)
+        losses = self._losses.copy()
+        if self._seen.any():
+            losses[~self._seen] = losses[self._seen].max()
+        else:
+            losses[:] = 1
+        total = losses.sum()
+        if not np.isfinite(total) or total <= 0:
+            return np.ones(k) / k
+        return (1 - self.uniform) * losses / total + self.uniform / k
+
+    def _iter_entries(self, update=True):
+        k = len(self.batches)
+        for _ in range(self.iteration_size):
+            probs = self.probabilities()
+            self._current = self.rng.choice(k, p=probs)
+            self.weight = 1. / (k * probs[self._current])
+            self._index += 1
+            yield self.batches[self._current]
+        if update:
+            self.update()
+
+    def observe(self, loss):
+        '''Record the loss of the most recently drawn mini-batch.
+
+        Parameters
+        ----------
+        loss : float
+            The value of the loss function on the mini-batch.
+        '''
+        i, s = self._current, self.smoothing
+        if self._seen[i]:
+            loss = s * self._losses[i] + (1 - s) * loss
+        self._losses[i] = loss
+        self._seen[i] = True
+
+    def get_state(self):
+        state = Dataset.get_state(self)
+        state['losses'] = self._losses.copy()
+        state['seen'] = self._seen.copy()
+        return state
+
+    def set_state(self, state):
+        Dataset.set_state(self, state)
+        self._losses[:] = state['losses']
+        self._seen[:] = state['seen']
+
+
+class ShardedDataset(Dataset):
+    '''A dataset that streams mini-batches from a directory of shards.
+
+    A sharded dataset is stored on disk as a directory containing a number of
+    ``.npy`` files ("shards"), each holding a fixed number of consecutive
+    samples (and labels, if any), plus an ``index.json`` file that records the
+    offset, size, shapes, and dtypes of the arrays in each shard. Use
+    :func:`write_shards` or :class:`ShardWriter` (or the ``theanets-shard.py``
+    script) to create a dataset in this format.
+
+    Each pass through the data visits the shards in a new random order. Shards
+    are read whole, one at a time, into an in-memory buffer of samples; the
+    buffer is shuffled and cut into mini-batches whenever it fills up. Every
+    byte of the dataset is thus read from disk exactly once per pass, in
+    sequential order, while memory use is bounded by the size of the buffer.
+
+    Parameters
+    ----------
+    path : str
+        Path to a directory containing a sharded dataset.
+    buffer_size : int, optional
+        Shuffle samples within a buffer holding at least this many samples.
+        Defaults to the size of the largest shard; larger buffers mix samples
+        from more shards into each mini-batch.
+
+    Other keyword arguments are the same as for :class:`Dataset`, except that
+    sharded datasets cannot be resident or quantized, and already shuffle
+    individual samples.
+    '''
+
+    def __init__(self, path, buffer_size=None, **kwargs):
+        self.buffer_size = buffer_size
+        Dataset.__init__(self, path, **kwargs)
+
+    def _init_arrays(self, samples, labels, axis):
+        if labels is not None:
+            raise ValueError('{}: labels must be stored in the shards of {}'
+                             .format(self.name, samples))
+        if self.quantize:
+            raise ValueError('{}: sharded datasets cannot be quantized'
+                             .format(self.name))
+        self.path = samples
+        self.resident = False
+        with open(os.path.join(samples, 'index.json')) as handle:
+            index = json.load(handle)
+        self._axis = index['axis']
+        self._shards = index['shards']
+        self._pass_state = self.rng.get_state()
+        self._pass_index = 0
+        self._stream = self._iter_stream()
+
+        count = sum(shard['size'] for shard in self._shards)
+        if not self.buffer_size:
+            self.buffer_size = max(shard['size'] for shard in self._shards)
+        if not self.iteration_size:
+            self.iteration_size = -(-count // self.batch_size)
+
+        logging.info('%s: %d mini-batches of %d from %d shards in %s',
+                     self.name, self.iteration_size, self.batch_size,
+                     len(self._shards), samples)
+
+    def shuffle(self):
+        pass  # shards and samples are reshuffled on every pass.
+
+    def get_state(self):
+        return dict(rng=self._pass_state, index=self._pass_index)
+
+    def set_state(self, state):
+        # replay the current pass from its beginning, up to the saved batch.
+        self.rng.set_state(state['rng'])
+        self._stream = self._iter_stream()
+        for _ in range(state['index']):
+            next(self._stream)
+
+    def _load(self, shard):
+        '''Read the arrays in one shard from disk.'''
+        return [np.load(os.path.join(self.path, array['file']))
+                for array in shard['arrays']]
+
+    def _cut(self, arrays, start, stop):
+        '''Slice a range of samples out of a list of arrays.'''
+        index = (slice(None), ) * self._axis + (slice(start, stop), )
+        return [a[index] for a in arrays]
+
+    def _iter_stream(self):
+        '''Yield mini-batches from passes through the shards, forever.'''
+        while True:
+            self._pass_state = self.rng.get_state()
+            self._pass_index = 0
+            pool, size = None, 0
+            order = self.rng.permutation(len(self._shards))
+            for n, i in enumerate(order):
+                arrays = self._load(self._shards[i])
+                if pool is not None:
+                    arrays = [np.concatenate([p, a], axis=self._axis)
+                              for p, a in zip(pool, arrays)]
+                pool = arrays
+                size = pool[0].shape[self._axis]
+                last = n == len(order) - 1
+                if size < self.buffer_size and not last:
+                    continue
+                # shuffle the buffer and emit all full batches; the remaining
+                # samples are mixed into the buffer for the next shard.
+                perm = self.rng.permutation(size)
+                pool = [np.take(a, perm, axis=self._axis) for a in pool]
+                end = size if last else size - size % self.batch_size
+                for start in range(0, end, self.batch_size):
+                    stop = min(end, start + self.batch_size)
+                    self._pass_index += 1
+                    yield self._cut(pool, start, stop)
+                pool = self._cut(pool, end, size)
+
+    def _iter_batches(self, update=True):
+        for _ in range(self.iteration_size):
+            yield self._apply_transform(next(self._stream))
+
+
+class ShardWriter(object):
+    '''Write a stream of arrays to disk as a sharded dataset.
+
+    Arrays are accumulated in memory until there are enough samples to fill a
+    shard; each full shard is then written to disk. Call :func:`close` after
+    appending all of the data to write the final (possibly smaller) shard and
+    the index file. Writers can also be used as context managers.
+
+    Parameters
+    ----------
+    path : str
+        Path of a directory to write the dataset to. It will be created if
+        needed.
+    shard_size : int, optional
+        Number of samples to store in each shard. Defaults to 65536.
+    axis : int, optional
+        The axis of the arrays that indexes samples. Defaults to 0.
+
+    See Also
+    --------
+    ShardedDataset : Reads datasets written in this format.
+    '''
+
+    def __init__(self, path, shard_size=65536, axis=0):
+        self.path = path
+        self.shard_size = shard_size
+        self.axis = axis
+        self.shards = []
+        self._offset = 0
+        self._pending = []
+        self._count = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, *arrays):
+        '''Append a batch of samples to the dataset.
+
+        Parameters
+        ----------
+        arrays : ndarray
+            One or more arrays (e.g., samples and labels), each containing the
+            same number of samples along our axis.
+        '''
+        arrays = [np.asarray(a) for a in arrays]
+        self._pending.append(arrays)
+        self._count += arrays[0].shape[self.axis]
+        while self._count >= self.shard_size:
+            self._flush(self.shard_size)
+
+    def _flush(self, size):
+        '''Write the first `size` pending samples to a new shard.'''
+        arrays = [np.concatenate(parts, axis=self.axis)
+                  for parts in zip(*self._pending)]
+        before = (slice(None), ) * self.axis
+        shard = dict(offset=self._offset, size=size, arrays=[])
+        for i, arr in enumerate(arrays):
+            name = '{:05d}-{}.npy'.format(len(self.shards), i)
+            np.save(os.path.join(self.path, name),
+                    arr[before + (slice(None, size), )])
+            shard['arrays'].append(dict(
+                file=name, shape=list(arr.shape), dtype=arr.dtype.str))
+            shard['arrays'][-1]['shape'][self.axis] = size
+        self.shards.append(shard)
+        self._offset += size
+        self._count -= size
+        self._pending = [[a[before + (slice(size, None), )] for a in arrays]]
+        logging.info('%s: wrote shard %d with %d samples',
+                     self.path, len(self.shards), size)
+
+    def close(self):
+        '''Write any pending samples and the index file for the dataset.'''
+        if self._count > 0:
+            self._flush(self._count)
+        self._pending = []
+        with open(os.path.join(self.path, 'index.json'), 'w') as handle:
+            json.dump(dict(axis=self.axis, shards=self.shards), handle)
+
+
+def write_shards(path, samples, labels=None, shard_size=65536, axis=0):
+    '''Write in-memory (or memory-mapped) arrays to disk as a sharded dataset.
+
+    Parameters
+    ----------
+    path : str
+        Path of a directory to write the dataset to.
+    samples : ndarray
+        An array of samples.
+    labels : ndarray, optional
+        An array of labels, with the same number of elements along `axis` as the
+        samples.
+    shard_size : int, optional
+        Number of samples to store in each shard. Defaults to 65536.
+    axis : int, optional
+        The axis of the arrays that indexes samples. Defaults to 0.
+    '''
+    arrays = [samples] if labels is None else [samples, labels]
+    before = (slice(None), ) * axis
+    with ShardWriter(path, shard_size=shard_size, axis=axis) as writer:
+        for i in range(0, samples.shape[axis], shard_size):
+            index = before + (slice(i, i + shard_size), )
+            writer.append(*[a[index] for a in arrays])
+
+
+def stratified_subset(samples, labels=None, size=1000, axis=None, rng=None):
+    '''Select a fixed subset of samples, stratified by class labels.
+
+    If the labels are a vector of integer class labels, each class is
+    represented in the subset in proportion to its frequency in the full set;
+    otherwise samples are drawn uniformly at random. Selected samples keep
+    their original relative order.
+
+    Parameters
+    ----------
+    samples : ndarray or sparse matrix
+        An array of sample data.
+    labels : ndarray, optional
+        An array of labels, one for each sample.
+    size : int, optional
+        Number of samples to select. Defaults to 1000.
+    axis : int, optional
+        The axis along which samples are arranged. Defaults to 1 for
+        3-dimensional arrays and 0 otherwise, as for :class:`Dataset`.
+    rng : int or numpy RandomState, optional
+        A random number generator, or a seed for one, used to select samples.
+        Using the same seed selects the same subset every time. Defaults to 0.
+
+    Returns
+    -------
+    samples : ndarray or sparse matrix
+        The selected samples.
+    labels : ndarray or None
+        The labels for the selected samples, if labels were given.
+    '''
+    if not isinstance(rng, np.random.RandomState):
+        rng = np.random.RandomState(rng or 0)
+    if axis is None:
+        axis = 1 if len(samples.shape) == 3 else 0
+    total = samples.shape[axis]
+    if size >= total:
+        return samples, labels
+    if labels is not None and labels.ndim == 1 and labels.dtype.kind in 'iu':
+        classes, members = np.unique(labels, return_inverse=True)
+        quota = size * np.bincount(members) / float(total)
+        counts = np.floor(quota).astype(int)
+        extra = np.argsort(counts - quota)[:size - counts.sum()]
+        counts[extra] += 1
+        index = np.concatenate([
+            rng.choice(np.where(members == c)[0], n, replace=False)
+            for c, n in enumerate(counts)])
+    else:
+        index = rng.choice(total, size, replace=False)
+    index.sort()
+    if scipy.sparse.issparse(samples):
+        samples = samples.tocsr()[index]
+    else:
+        samples = np.take(samples, index, axis=axis)
+    if labels is not None:
+        labels = np.take(labels, index, axis=axis)
+    return samples, labels
+
+
+class BatchCache(object):
+    '''Cache the mini-batches that a keyed callable returns.
+
+    Mini-batches are kept in memory in least-recently-used order, up to a fixed
+    number of batches. Batches that are evicted from memory can optionally be
+    spilled to ``.npz`` files on disk, from where they are loaded again (rather
+    than being regenerated) when they are next requested. Files on disk are
+    not removed, so a cache directory can be reused across runs as long as the
+    callable keeps returning the same batch for each key.
+
+    Parameters
+    ----------
+    source : callable
+        A callable that takes one hashable key and returns a sequence of
+        ndarrays.
+    size : int, optional
+        Maximum number of mini-batches to hold in memory. Defaults to 0, which
+        keeps no batches in memory.
+    path : str, optional
+        Directory where evicted batches are saved. Defaults to None, which
+        discards evicted batches.
+    '''
+
+    def __init__(self, source, size=0, path=None):
+        self.source = source
+        self.size = size
+        self.path = path
+        self.hits = self.misses = 0
+        self._batches = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __call__(self, key):
+        with self._lock:
+            batch = self._batches.pop(key, None)
+        if batch is None:
+            batch = self._load(key)
+        if batch is None:
+            self.misses += 1
+            batch = [np.asarray(a) for a in self.source(key)]
+        else:
+            self.hits += 1
+        self._store(key, batch)
+        return batch
+
+    def _filename(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '{}.npz'.format(digest))
+
+    def _load(self, key):
+        '''Load a batch that was spilled to disk, if any.'''
+        if not self.path or not os.path.exists(self._filename(key)):
+            return None
+        with np.load(self._filename(key)) as arrays:
+            count = len(arrays.files)
+            return [arrays['arr_{}'.format(i)] for i in range(count)]
+
+    def _save(self, key, batch):
+        '''Spill a batch to disk, unless it is already there.'''
+        if self.path and not os.path.exists(self._filename(key)):
+            np.savez(self._filename(key), *batch)
+
+    def _store(self, key, batch):
+        '''Mark a batch as most recently used, evicting the oldest batches.'''
+        evicted = [(key, batch)]
+        if self.size > 0:
+            with self._lock:
+                self._batches[key] = batch
+                evicted = []
+                while len(self._batches) > self.size:
+                    evicted.append(self._batches.popitem(last=False))
+        for key, batch in evicted:
+            self._save(key, batch)
+
+    def clear(self):
+        '''Drop all batches held in memory.'''
+        with self._lock:
+            self._batches.clear()
+
+
+def _pool_worker(source, buffers, layout, free, ready, seed):
+    '''Fill shared-memory batch buffers with values from a callable.'''
+    # interrupts are handled by the training process, which shuts us down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    rng.seed(seed)
+    while True:
+        slot = free.get()
+        if slot is None:
+            break
+        try:
+            for view, arr in zip(WorkerPool.views(buffers[slot], layout),
+                                 source()):
+                view[...] = arr
+            ready.put((slot, None))
+        except Exception:
+            ready.put((slot, traceback.format_exc()))
+
+
+class WorkerPool(object):
+    '''Generate mini-batches from a callable in a pool of worker processes.
+
+    Each worker process calls the callable repeatedly and copies the arrays it
+    returns into one of a ring of shared-memory buffers; the training process
+    reads batches directly out of these buffers, so batch data are never
+    pickled. A buffer is handed back to the workers as soon as the next batch is
+    requested, so a batch is only valid until then.
+
+    Worker processes ignore keyboard interrupts; call :func:`close` to shut the
+    pool down. This happens automatically when the Python process exits.
+
+    Parameters
+    ----------
+    source : callable
+        A callable that takes no arguments and returns a sequence of ndarrays.
+        It is called once in the current process to determine the shapes and
+        dtypes of the batch buffers, so every call must return arrays with the
+        same shapes and dtypes.
+    workers : int
+        Number of worker processes to start.
+    slots : int, optional
+        Number of shared-memory buffers to allocate for each worker. Defaults
+        to 2.
+    seed : int, optional
+        Seed for the ``numpy`` random number generators in the workers. Worker
+        `i` is seeded with `seed + i`. Defaults to a value drawn from the
+        current random state.
+    '''
+
+    def __init__(self, source, workers, slots=2, seed=None):
+        try:
+            context = multiprocessing.get_context('fork')
+        except (AttributeError, ValueError):  # Python 2.x or no fork
+            context = multiprocessing
+        if seed is None:
+            seed = rng.randint(1 << 30)
+
+        # lay out each batch in a flat shared buffer, aligning every array.
+        self.layout, offset = [], 0
+        for arr in (np.asarray(a) for a in source()):
+            self.layout.append((offset, arr.shape, arr.dtype))
+            offset += (arr.nbytes + 63) // 64 * 64
+        self._buffers = [context.RawArray('b', max(1, offset))
+                         for _ in range(workers * slots)]
+        self._views = [WorkerPool.views(b, self.layout) for b in self._buffers]
+
+        self._free = context.Queue()
+        self._ready = context.Queue()
+        for slot in range(len(self._buffers)):
+            self._free.put(slot)
+
+        self._processes = []
+        for i in range(workers):
+            proc = context.Process(target=_pool_worker, args=(
+                source, self._buffers, self.layout,
+                self._free, self._ready, seed + i))
+            proc.daemon = True
+            proc.start()
+            self._processes.append(proc)
+        atexit.register(self.close)
+
+        logging.info('started %d batch workers with %d shared buffers',
+                     workers, len(self._buffers))
+
+    @staticmethod
+    def views(buffer, layout):
+        '''Get ndarray views of the batch arrays in a shared buffer.'''
+        raw = np.frombuffer(buffer, np.uint8)
+        return [raw[o:o + int(np.prod(s)) * np.dtype(d).itemsize]
+                .view(d).reshape(s) for o, s, d in layout]
+
+    def iterate(self, count):
+        '''Yield a number of batches from the workers.
+
+        Parameters
+        ----------
+        count : int
+            Number of batches to yield.
+        '''
+        held = None
+        try:
+            for _ in range(count):
+                slot, error = self._ready.get()
+                if held is not None:
+                    self._free.put(held)
+                held = slot
+                if error is not None:
+                    raise RuntimeError('batch worker failed:\n' + error)
+                yield self._views[slot]
+        finally:
+            if held is not None:
+                self._free.put(held)
+
+    def close(self):
+        '''Stop the worker processes.'''
+        procs, self._processes = self._processes, []
+        for _ in procs:
+            self._free.put(None)
+        for proc in procs:
+            proc.join(1)
+            if proc.is_alive():
+                proc.terminate()
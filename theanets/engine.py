@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+
+r'''This module contains a pure-``numpy`` inference engine for networks.
+
+Computing predictions with a :class:`Network <theanets.feedforward.Network>`
+requires compiling theano functions, which is slow to start up and pulls in
+theano and a compiler wherever predictions are needed. An :class:`Engine`
+instead holds a copy of the parameters of a trained feedforward network and
+computes its forward pass using ``numpy`` alone, with matrix products written
+into preallocated buffers that are reused from one call to the next.
+
+Engines are created from trained networks and saved to ``.npz`` files::
+
+  engine = theanets.engine.Engine.from_network(net, sample=x_valid[:100])
+  engine.save('model-engine.npz')
+
+and then loaded wherever predictions are needed::
+
+  engine = Engine.load('model-engine.npz')
+  y = engine.predict(x)
+
+This module only depends on ``numpy``. If theano is not installed, importing
+the ``theanets`` package only provides this module and :mod:`theanets.serve`,
+so engines can be loaded and served on machines without theano.
+
+Engines support networks built from :class:`Input <theanets.layers.Input>`,
+:class:`Feedforward <theanets.layers.Feedforward>`, :class:`Classifier
+<theanets.layers.Classifier>`, :class:`Tied <theanets.layers.Tied>`, and
+:class:`Maxout <theanets.layers.Maxout>` layers, using any of the activation
+functions from :func:`create_activation
+<theanets.layers.create_activation>`, and :class:`Affine
+<theanets.preprocess.Affine>` input transforms.
+
+The weights of feedforward and tied layers can be quantized after training
+(see :func:`Engine.quantize`) to int8 values with a scale for each column, or
+to float16 values. Quantized weights take a quarter or half of the memory, and
+are converted back to floats one block of rows at a time while computing the
+forward pass, so products are still accumulated at full precision. Use
+:func:`Engine.report` to measure how much quantization changes the outputs of
+a model on held-out data::
+
+  small = engine.quantize('int8')
+  print(small.report(net, x_test, y_test))
+'''
+
+import collections
+import functools
+import json
+import numpy as np
+
+# layer forms that engines can compute.
+FORMS = ('input', 'feedforward', 'tied', 'maxout')
+
+
+def _norm(z, scale):
+    z /= np.maximum(1e-7, scale)
+    return z
+
+
+def _sigmoid(z):
+    with np.errstate(over='ignore'):
+        np.negative(z, out=z)
+        np.exp(z, out=z)
+    z += 1
+    return np.reciprocal(z, out=z)
+
+
+def _softmax(z):
+    z -= z.max(axis=-1, keepdims=True)
+    np.exp(z, out=z)
+    z /= z.sum(axis=-1, keepdims=True)
+    return z
+
+
+def _zscore(z):
+    std = z.std(axis=-1, keepdims=True)
+    z -= z.mean(axis=-1, keepdims=True)
+    return _norm(z, std)
+
+
+def create_activation(activation):
+    '''Get a ``numpy`` implementation of an activation function.
+
+    The returned callables may modify their argument in place.
+
+    Parameters
+    ----------
+    activation : str
+        The name of an activation function, as for
+        :func:`theanets.layers.create_activation`.
+
+    Returns
+    -------
+    activation : callable(ndarray) -> ndarray
+        A callable activation function.
+    '''
+    if '+' in activation:
+        funcs = [create_activation(a) for a in activation.split('+')]
+        return lambda z: functools.reduce(lambda x, f: f(x), funcs, z)
+    options = {
+        'tanh': lambda z: np.tanh(z, out=z),
+        'linear': lambda z: z,
+        'logistic': _sigmoid,
+        'sigmoid': _sigmoid,
+        'softplus': lambda z: np.logaddexp(0, z, out=z),
+        'softmax': _softmax,
+
+        # rectification
+        'relu': lambda z: np.maximum(z, 0, out=z),
+        'trel': lambda z: np.clip(z, 0, 1, out=z),
+        'trec': lambda z: np.maximum(z, 1, out=z),
+        'tlin': lambda z: np.multiply(z, abs(z) > 1, out=z),
+
+        # modifiers
+        'rect:max': lambda z: np.minimum(z, 1, out=z),
+        'rect:min': lambda z: np.maximum(z, 0, out=z),
+
+        # normalization
+        'norm:dc': lambda z: np.subtract(
+            z, z.mean(axis=-1, keepdims=True), out=z),
+        'norm:max': lambda z: _norm(z, abs(z).max(axis=-1, keepdims=True)),
+        'norm:std': lambda z: _norm(z, z.std(axis=-1, keepdims=True)),
+        'norm:z': _zscore,
+    }
+    try:
+        return options[activation.lower()]
+    except KeyError:
+        raise KeyError('unknown activation {}'.format(activation))
+
+
+class Engine(object):
+    '''Compute the forward pass of a feedforward network using ``numpy``.
+
+    Engines are usually created with :func:`from_network` or :func:`load`.
+    Outputs are computed into buffers that belong to the engine, so an array
+    returned by :func:`predict` or :func:`feed_forward` is only valid until the
+    engine is called again, and an engine must not be called from several
+    threads at once.
+
+    Parameters
+    ----------
+    layers : list of dict
+        A description of each layer of the network. Each dictionary contains
+        the 'name' of the layer, its 'form' (one of 'input', 'feedforward',
+        'tied', or 'maxout'), the name of its 'activation' function, the
+        indices of the layers whose outputs are its 'inputs', and a list of
+        'weights' (one per input) and a 'bias', as ndarrays. Quantized int8
+        weights also need a list of per-column 'scales' (one per weight).
+    transform : dict, optional
+        Arrays describing an affine input transform: an 'offset', plus an
+        optional 'scale' or 'matrix'.
+    block_size : int, optional
+        Number of rows of quantized weights to convert to floats at a time.
+        Defaults to 256.
+    '''
+
+    def __init__(self, layers, transform=None, block_size=256):
+        self.layers = layers
+        self.transform = transform or {}
+        self.block_size = block_size
+        for layer in layers:
+            if layer['form'] not in FORMS:
+                raise ValueError('cannot compute {} layer {}'.format(
+                    layer['form'], layer['name']))
+            layer['activate'] = create_activation(layer['activation'])
+        biases = [l['bias'] for l in layers if l['bias'] is not None]
+        self.dtype = biases[0].dtype if biases else np.dtype('float32')
+        self._buffers = {}
+
+    @property
+    def nbytes(self):
+        '''Number of bytes used by the parameters of this engine.'''
+        return sum(a.nbytes for l in self.layers
+                   for a in l['weights'] + l.get('scales', []) + [l['bias']]
+                   if a is not None)
+
+    @classmethod
+    def from_network(cls, network, sample=None, atol=1e-4):
+        '''Create an engine from a trained network.
+
+        Parameters
+        ----------
+        network : :class:`Network <theanets.feedforward.Network>`
+            A feedforward network. The engine holds copies of its parameters.
+        sample : ndarray, optional
+            If given, check that the engine computes the same outputs as the
+            network for these inputs (see :func:`verify`).
+        atol : float, optional
+            Largest absolute difference allowed when checking outputs. Defaults
+            to 1e-4.
+
+        Raises
+        ------
+        ValueError
+            If the network contains layers or an input transform that engines
+            cannot compute, or if the outputs for `sample` do not match.
+
+        Returns
+        -------
+        engine : :class:`Engine`
+            An engine that computes the forward pass of the network.
+        '''
+        from . import layers as L
+        if network.kwargs.get('input_type', 'dense') != 'dense':
+            raise ValueError('engines only handle dense inputs')
+        decode = network.kwargs.get('decode_from', 1)
+        specs = []
+        for i, layer in enumerate(network.layers):
+            spec = dict(name=layer.name, weights=[], bias=None,
+                        activation=layer.kwargs.get('activation', 'logistic'),
+                        inputs=[i - 1])
+            if i == len(network.layers) - 1:
+                spec['inputs'] = list(range(i - decode, i))
+            if isinstance(layer, L.Input):
+                spec.update(form='input', inputs=[])
+            elif isinstance(layer, L.Feedforward):
+                spec['form'] = 'feedforward'
+                spec['weights'] = [layer.find(str(j)).get_value()
+                                   for j in range(len(spec['inputs']))]
+            elif isinstance(layer, L.Tied):
+                spec['form'] = 'tied'
+                spec['weights'] = [np.ascontiguousarray(
+                    layer.partner.find('0').get_value().T)]
+            elif isinstance(layer, L.Maxout):
+                spec['form'] = 'maxout'
+                spec['weights'] = [layer.find('xh').get_value()]
+            else:
+                raise ValueError('cannot compute {} layer {}'.format(
+                    layer.__class__.__name__, layer.name))
+            if spec['form'] != 'input':
+                spec['bias'] = layer.find('b').get_value()
+            specs.append(spec)
+        transform = None
+        affine = network.kwargs.get('input_transform')
+        if affine is not None:
+            if not hasattr(affine, 'offset'):
+                raise ValueError('engines only handle affine input transforms')
+            transform = dict(offset=affine.offset)
+            for key in ('scale', 'matrix'):
+                if getattr(affine, key, None) is not None:
+                    transform[key] = getattr(affine, key)
+        engine = cls(specs, transform)
+        if sample is not None:
+            engine.verify(network, sample, atol)
+        return engine
+
+    def _buffer(self, key, shape):
+        '''Get a reusable output buffer with the given shape.'''
+        buf = self._buffers.get(key)
+        if buf is None or len(buf) < shape[0] or buf.shape[1:] != shape[1:]:
+            buf = self._buffers[key] = np.empty(shape, self.dtype)
+        return buf[:shape[0]]
+
+    def _compute(self, i, layer, inputs):
+        '''Compute the output of one layer, given its inputs.'''
+        form = layer['form']
+        if form == 'input':
+            return inputs[0]
+        x = inputs[0]
+        w = layer['weights'][0]
+        if form == 'maxout':
+            # this follows the tensordot semantics of the theano layer, which
+            # are the same as those of np.dot for 3-dimensional weights.
+            shape = (len(x), w.shape[0], w.shape[2])
+            pieces = self._buffer((i, 'pieces'), shape)
+            np.dot(x, w, out=pieces)
+            out = self._buffer(i, shape[:2])
+            pieces.max(axis=2, out=out)
+        else:
+            weights = layer['weights']
+            scales = layer.get('scales') or [None] * len(weights)
+            out = self._buffer(i, (len(x), w.shape[1]))
+            self._dot((i, 0), x, w, scales[0], out)
+            for j in range(1, len(weights)):
+                tmp = self._buffer((i, j), out.shape)
+                out += self._dot((i, j), inputs[j], weights[j], scales[j], tmp)
+        out += layer['bias']
+        return layer['activate'](out)
+
+    def _dot(self, key, x, w, scale, out):
+        '''Multiply inputs by (possibly quantized) weights into a buffer.'''
+        if w.dtype == self.dtype:
+            return np.dot(x, w, out=out)
+        # convert quantized weights to floats one block of rows at a time, and
+        # accumulate the products at full precision. per-column scales can be
+        # applied once to the sum.
+        size = min(self.block_size, len(w))
+        block = self._buffer((key, 'block'), (size, w.shape[1]))
+        tmp = self._buffer((key, 'tmp'), out.shape)
+        out.fill(0)
+        for start in range(0, len(w), size):
+            part = block[:len(w[start:start + size])]
+            np.copyto(part, w[start:start + size], casting='unsafe')
+            out += np.dot(x[:, start:start + len(part)], part, out=tmp)
+        if scale is not None:
+            out *= scale
+        return out
+
+    def quantize(self, dtype='int8'):
+        '''Create a copy of this engine with quantized weights.
+
+        Only the weights of feedforward and tied layers are quantized; biases,
+        maxout weights, and input transforms are kept as they are.
+
+        Parameters
+        ----------
+        dtype : str, optional
+            Either 'int8', which stores each weight as an 8-bit integer times a
+            scale for its column (i.e., its output unit), or 'float16', which
+            stores weights as half-precision floats. Defaults to 'int8'.
+
+        Returns
+        -------
+        engine : :class:`Engine`
+            An engine with quantized weights.
+        '''
+        if dtype not in ('int8', 'float16'):
+            raise ValueError('cannot quantize to {}'.format(dtype))
+        layers = []
+        for layer in self.layers:
+            layer = dict(layer)
+            if layer['form'] in ('feedforward', 'tied'):
+                weights, scales = [], []
+                for w in layer['weights']:
+                    w = np.asarray(w, self.dtype)
+                    if dtype == 'float16':
+                        weights.append(w.astype(np.float16))
+                        continue
+                    scale = abs(w).max(axis=0) / 127
+                    scale[scale == 0] = 1
+                    weights.append(np.clip(
+                        np.round(w / scale), -127, 127).astype(np.int8))
+                    scales.append(scale.astype(self.dtype))
+                layer['weights'] = weights
+                if scales:
+                    layer['scales'] = scales
+            layers.append(layer)
+        return self.__class__(layers, self.transform, self.block_size)
+
+    def report(self, network, x, labels=None):
+        '''Compare the outputs of this engine and a network on some data.
+
+        Parameters
+        ----------
+        network : :class:`Network <theanets.feedforward.Network>`
+            A reference model; this is usually the network (or unquantized
+            engine) that this engine was created from. It must have a
+            ``predict`` method.
+        x : ndarray
+            Held-out input data.
+        labels : ndarray, optional
+            Class labels for the input data. If given, the classification
+            accuracy of both models is reported, assuming that the predicted
+            class is the output unit with the largest value.
+
+        Returns
+        -------
+        report : OrderedDict
+            A dictionary containing the largest and mean absolute difference
+            between outputs, the mean difference relative to the output scale
+            of the reference, the percentage of inputs for which both models
+            predict the same class, the accuracy of each model and their
+            difference (if labels are given), and the number of bytes used by
+            the parameters of this engine.
+        '''
+        expected = np.asarray(network.predict(x))
+        actual = self.predict(x).copy()
+        error = abs(actual - expected)
+        report = collections.OrderedDict()
+        report['max_error'] = float(error.max())
+        report['mean_error'] = float(error.mean())
+        report['relative_error'] = float(
+            error.mean() / max(1e-12, abs(expected).mean()))
+        classes = expected.argmax(axis=-1), actual.argmax(axis=-1)
+        report['agreement'] = 100 * float((classes[0] == classes[1]).mean())
+        if labels is not None:
+            labels = np.asarray(labels).reshape(classes[0].shape)
+            report['reference_accuracy'] = 100 * float(
+                (classes[0] == labels).mean())
+            report['accuracy'] = 100 * float((classes[1] == labels).mean())
+            report['accuracy_delta'] = \
+                report['accuracy'] - report['reference_accuracy']
+        report['bytes'] = self.nbytes
+        return report
+
+    def feed_forward(self, x):
+        '''Compute a forward pass of all layers from the given input.
+
+        Parameters
+        ----------
+        x : ndarray (num-examples, num-variables)
+            An array of input data, with one example per row.
+
+        Returns
+        -------
+        layers : list of ndarray (num-examples, num-units)
+            The activation values of each layer in the network. The "output" of
+            the network is the last element of this list.
+        '''
+        x = np.ascontiguousarray(x, self.dtype)
+        if self.transform:
+            x = x - self.transform['offset']
+            if 'scale' in self.transform:
+                x *= self.transform['scale']
+            if 'matrix' in self.transform:
+                x = np.dot(x, self.transform['matrix'])
+        outputs = []
+        for i, layer in enumerate(self.layers):
+            inputs = [outputs[j] for j in layer['inputs']] or [x]
+            outputs.append(self._compute(i, layer, inputs))
+        return outputs
+
+    def predict(self, x):
+        '''Compute the network output for the given input.
+
+        Parameters
+        ----------
+        x : ndarray (num-examples, num-variables)
+            An array of input data, with one example per row.
+
+        Returns
+        -------
+        y : ndarray (num-examples, num-outputs)
+            The values of the network output units for each input example.
+        '''
+        return self.feed_forward(x)[-1]
+
+    __call__ = predict
+
+    def verify(self, network, x, atol=1e-4):
+        '''Check that this engine computes the same outputs as a network.
+
+        Parameters
+        ----------
+        network : :class:`Network <theanets.feedforward.Network>`
+            The network to compare against.
+        x : ndarray
+            Input data to use for the comparison.
+        atol : float, optional
+            Largest absolute difference allowed between outputs. Defaults to
+            1e-4.
+
+        Raises
+        ------
+        ValueError
+            If any output differs by more than `atol`.
+
+        Returns
+        -------
+        error : float
+            The largest absolute difference between outputs.
+        '''
+        error = float(abs(self.predict(x) - network.predict(x)).max())
+        if not error <= atol:
+            raise ValueError(
+                'engine outputs differ from network by {}'.format(error))
+        return error
+
+    def save(self, filename):
+        '''Save this engine to a ``.npz`` file.
+
+        Parameters
+        ----------
+        filename : str
+            Path of the file to write.
+        '''
+        arrays, config = {}, []
+        for i, layer in enumerate(self.layers):
+            for j, w in enumerate(layer['weights']):
+                arrays['layer{}_w{}'.format(i, j)] = w
+            for j, scale in enumerate(layer.get('scales', ())):
+                arrays['layer{}_s{}'.format(i, j)] = scale
+            if layer['bias'] is not None:
+                arrays['layer{}_b'.format(i)] = layer['bias']
+            keys = ('name', 'form', 'activation', 'inputs')
+            config.append(dict((k, layer[k]) for k in keys))
+            config[-1]['weights'] = len(layer['weights'])
+        for key, value in self.transform.items():
+            arrays['transform_{}'.format(key)] = value
+        arrays['config'] = np.array(json.dumps(config))
+        arrays['block_size'] = np.array(self.block_size)
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        '''Load an engine from a ``.npz`` file.
+
+        Parameters
+        ----------
+        filename : str
+            Path of a file written by :func:`save`.
+
+        Returns
+        -------
+        engine : :class:`Engine`
+            The loaded engine.
+        '''
+        with np.load(filename) as arrays:
+            layers = json.loads(str(arrays['config']))
+            for i, layer in enumerate(layers):
+                layer['weights'] = [arrays['layer{}_w{}'.format(i, j)]
+                                    for j in range(layer['weights'])]
+                key = 'layer{}_b'.format(i)
+                layer['bias'] = arrays[key] if key in arrays.files else None
+                key = 'layer{}_s{}'.format
+                if key(i, 0) in arrays.files:
+                    layer['scales'] = [arrays[key(i, j)]
+                                       for j in range(len(layer['weights']))]
+            transform = dict(
+                (key[10:], arrays[key]) for key in arrays.files
+                if key.startswith('transform_'))
+            block_size = int(arrays['block_size'])
+        return cls(layers, transform, block_size)
@@ -79,13 +79,16 @@ import gzip
 import hashlib
 import numpy as np
 import pickle
+import scipy.sparse
 import theano
+import theano.sparse
 import theano.tensor as TT
 
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
 logging = climate.get_logger(__name__)
 
+from . import cache
 from . import layers
 
 FLOAT = theano.config.floatX
@@ -154,6 +157,27 @@ class Network(object):
         Any of the hidden layers can be tapped at the output. Just specify a
         value greater than 1 to tap the last N hidden layers. The default is 1,
         which decodes from just the last layer.
+    input_type : str, optional
+        The type of input data for the network. The default is 'dense', which
+        takes a dense matrix of inputs. Use 'sparse' to take a
+        ``scipy.sparse.csr_matrix`` of inputs instead; the first layer then
+        multiplies only the nonzero input values by its weights. Use 'index'
+        to take integer indices (a vector for feedforward networks, a matrix
+        of time steps by sequences for recurrent networks), typically followed
+        by an :class:`Embedding <layers.Embedding>` layer. Noise and dropout
+        cannot be applied to sparse or index inputs.
+    input_transform : callable, optional
+        A transform to apply to the input inside the computation graph, before
+        the input layer; for example, an :class:`Affine
+        <theanets.preprocess.Affine>` normalization or whitening transform. It
+        is called with the symbolic input and must return a theano expression.
+        The size of the input layer must match the size of the transformed
+        input.
+    function_cache : str, optional
+        A directory for storing compiled functions (see
+        :class:`FunctionCache <theanets.cache.FunctionCache>`), so that
+        processes that create the same network can skip compiling them.
+        Defaults to None, which compiles functions every time.
 
     Attributes
     ----------
@@ -188,7 +212,13 @@ class Network(object):
             A list of the variables that this network requires as inputs.
         '''
         # x represents our network's input.
-        self.x = TT.matrix('x')
+        input_type = self.kwargs.get('input_type', 'dense')
+        if input_type == 'sparse':
+            self.x = theano.sparse.csr_matrix('x', dtype=FLOAT)
+        elif input_type == 'index':
+            self.x = TT.ivector('x')
+        else:
+            self.x = TT.matrix('x')
         return [self.x]
 
     def error(self, output):
@@ -204,7 +234,10 @@ class Network(object):
         error : theano expression
             A theano expression representing the network error.
         '''
-        err = output - self.x
+        x = self.x
+        if isinstance(x.type, theano.sparse.SparseType):
+            x = theano.sparse.dense_from_sparse(x)
+        err = output - x
         return TT.mean((err * err).sum(axis=1))
 
     def setup_layers(self):
@@ -389,6 +422,9 @@ class Network(object):
                 if i == 0:
                     # input to first layer is data.
                     inputs = self.x
+                    transform = self.kwargs.get('input_transform')
+                    if transform is not None:
+                        inputs = transform(inputs)
                     noise = kwargs.get('input_noise', 0)
                     dropout = kwargs.get('input_dropouts', 0)
                 elif i == len(self.layers) - 1:
@@ -460,7 +496,17 @@ class Network(object):
                 return l.find(param)
         raise KeyError(layer)
 
-    def feed_forward(self, x, **kwargs):
+    def _layer_index(self, layer):
+        '''Get the index of a layer, given its index or name.'''
+        for i, l in enumerate(self.layers):
+            if layer == l.name:
+                return i
+        count = len(self.layers)
+        if isinstance(layer, int) and -count <= layer < count:
+            return layer % count
+        raise KeyError(layer)
+
+    def feed_forward(self, x, layers=None, **kwargs):
         '''Compute a forward pass of all layers from the given input.
 
         All keyword arguments are passed directly to :func:`build_graph`.
@@ -471,6 +517,12 @@ class Network(object):
             An array containing data to be fed into the network. Multiple
             examples are arranged as rows in this array, with columns containing
             the variables for each example.
+        layers : sequence of int or str, optional
+            Compute only the activations of these layers, given by index (0 is
+            the input layer, -1 the output layer) or by name. A separate
+            function that returns only these activations is compiled for each
+            distinct selection. Defaults to None, which returns the activations
+            of all layers.
 
         Returns
         -------
@@ -479,13 +531,23 @@ class Network(object):
             input `x`. For each of the hidden layers, an array is returned
             containing one row per input example; the columns of each array
             correspond to units in the respective layer. The "output" of the
-            network is the last element of this list.
+            network is the last element of this list. If `layers` is given,
+            the list only contains the activations of those layers, in the
+            given order.
         '''
-        key = self._hash(**kwargs)
+        select = None
+        if layers is not None:
+            select = tuple(self._layer_index(l) for l in layers)
+        key = self._hash(**kwargs), select
         if key not in self._functions:
             outputs, _, updates = self.build_graph(**kwargs)
-            self._functions[key] = theano.function(
-                [self.x], outputs, updates=updates)
+            if select is not None:
+                outputs = [outputs[i] for i in select]
+            self._functions[key] = cache.function(
+                [self.x], outputs, updates=updates,
+                cache=self.kwargs.get('function_cache'),
+                key=('feed_forward', self.__class__.__name__),
+                max_size=self.kwargs.get('function_cache_size', 1 << 30))
         return self._functions[key](x)
 
     def predict(self, x):
@@ -505,10 +567,113 @@ class Network(object):
             Rows in this array correspond to examples, and columns to output
             variables.
         '''
-        return self.feed_forward(x)[-1]
+        return self.feed_forward(x, layers=[-1])[0]
 
     __call__ = predict
 
+    @staticmethod
+    def _chunks(x, chunk_size, axis):
+        '''Split input data into chunks along the given axis.'''
+        if not hasattr(x, 'shape'):
+            for chunk in x:
+                yield chunk
+            return
+        for i in range(0, x.shape[axis], chunk_size):
+            if axis == 0 or scipy.sparse.issparse(x):
+                yield x[i:i + chunk_size]
+            else:
+                yield x[(slice(None), ) * axis + (slice(i, i + chunk_size), )]
+
+    def predict_iter(self, x, chunk_size=1024, axis=None):
+        '''Compute network outputs for input data one chunk at a time.
+
+        Parameters
+        ----------
+        x : ndarray, sparse matrix, or iterable of ndarray
+            Input data. Arrays (including memory-mapped arrays) are split into
+            chunks of `chunk_size` examples; otherwise `x` is expected to yield
+            chunks of input data, which are used as given.
+        chunk_size : int, optional
+            Number of examples in each chunk of an input array. Defaults to
+            1024.
+        axis : int, optional
+            Axis of the input arrays along which examples are arranged.
+            Defaults to 1 for 3-dimensional inputs (i.e., for recurrent
+            networks), and 0 otherwise.
+
+        Yields
+        ------
+        y : ndarray
+            The network output for one chunk of input data.
+        '''
+        if axis is None:
+            axis = 1 if len(getattr(x, 'shape', ())) == 3 else 0
+        for chunk in self._chunks(x, chunk_size, axis):
+            yield self.predict(chunk)
+
+    def predict_chunked(self, x, chunk_size=1024, out=None, axis=None):
+        '''Compute network outputs for a large input, in bounded memory.
+
+        Parameters
+        ----------
+        x : ndarray, sparse matrix, or iterable of ndarray
+            Input data, as for :func:`predict_iter`.
+        chunk_size : int, optional
+            Number of examples in each chunk of an input array. Defaults to
+            1024.
+        out : ndarray or str, optional
+            An array (e.g., a ``np.memmap``) to write outputs into, or the path
+            of a ``.npy`` file to create as a memory-mapped output array. The
+            path can only be used when `x` is an array, so that the size of
+            the output is known in advance. Defaults to None, which allocates
+            a new array for the outputs. If `x` is an iterable, this array is
+            assembled from all of the output chunks at the end, so memory use
+            is only bounded when `x` is an array or `out` is given.
+        axis : int, optional
+            Axis along which examples are arranged in the input and output
+            arrays. Defaults to 1 for 3-dimensional inputs, and 0 otherwise.
+
+        Returns
+        -------
+        y : ndarray
+            The network outputs for all of the input data.
+        '''
+        if axis is None:
+            axis = 1 if len(getattr(x, 'shape', ())) == 3 else 0
+        if out is None and not hasattr(x, 'shape'):
+            return np.concatenate(
+                list(self.predict_iter(x, chunk_size, axis)), axis=axis)
+        if isinstance(out, str) and not hasattr(x, 'shape'):
+            raise ValueError('cannot create an output file of unknown size')
+        chunks = self.predict_iter(x, chunk_size, axis)
+        if hasattr(x, 'shape') and x.shape[axis] == 0:
+            # compute one example of zeros to get the shape of empty outputs.
+            shape = list(x.shape)
+            shape[axis] = 1
+            if scipy.sparse.issparse(x):
+                zeros = scipy.sparse.csr_matrix(tuple(shape), dtype=x.dtype)
+            else:
+                zeros = np.zeros(shape, x.dtype)
+            y = self.predict(zeros)
+            chunks = [y[(slice(None), ) * axis + (slice(0, 0), )]]
+        offset = 0
+        for y in chunks:
+            if out is None or isinstance(out, str):
+                shape = list(y.shape)
+                shape[axis] = x.shape[axis]
+                if out is None:
+                    out = np.empty(shape, y.dtype)
+                else:
+                    out = np.lib.format.open_memmap(
+                        out, mode='w+', dtype=y.dtype, shape=tuple(shape))
+            n = y.shape[axis]
+            index = (slice(None), ) * axis + (slice(offset, offset + n), )
+            out[index] = y
+            offset += n
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
     def save(self, filename):
         '''Save the state of this network to a pickle file on disk.
 
@@ -763,10 +928,11 @@ class Autoencoder(Network):
             A dataset to encode. Rows of this dataset capture individual data
             points, while columns represent the variables in each data point.
 
-        layer : int, optional
-            The index of the hidden layer activation to use. By default, we use
-            the "middle" hidden layer---for example, for a 4,2,4 or 4,3,2,3,4
-            autoencoder, we use the "2" layer (index 1 or 2, respectively).
+        layer : int or str, optional
+            The index or name of the hidden layer activation to use. By default,
+            we use the "middle" hidden layer---for example, for a 4,2,4 or
+            4,3,2,3,4 autoencoder, we use the "2" layer (index 1 or 2,
+            respectively).
 
         sample : bool, optional
             If True, then draw a sample using the hidden activations as
@@ -779,7 +945,7 @@ class Autoencoder(Network):
             The given dataset, encoded by the appropriate hidden layer
             activation.
         '''
-        enc = self.feed_forward(x)[(layer or len(self.layers) // 2)]
+        enc, = self.feed_forward(x, layers=[layer or len(self.layers) // 2])
         if sample:
             return np.random.binomial(n=1, p=enc).astype(np.uint8)
         return enc
@@ -18,6 +18,9 @@ g.add_argument('-t', '--tied-weights', action='store_true',
                help='tie encoding and decoding weights')
 g.add_argument('--decode-from', type=int, default=1, metavar='N',
                help='decode from the final N layers of the net')
+g.add_argument('--input-type', default='dense',
+               choices=('dense', 'sparse', 'index'),
+               help='type of input data for the net')
 
 g = climate.add_group('Training')
 g.add_argument('-O', '--optimize', default=(), nargs='+', metavar='ALGO',
@@ -32,6 +35,32 @@ g.add_argument('-B', '--train-batches', type=int, metavar='N',
                help='use at most N batches during gradient computations')
 g.add_argument('-V', '--valid-batches', type=int, metavar='N',
                help='use at most N batches during validation')
+g.add_argument('--valid-subset', type=int, metavar='N',
+               help='validate on a fixed subset of N samples, stratified by class')
+g.add_argument('--valid-confidence', type=float, default=0, metavar='Z',
+               help='stop validating once loss is Z std. errors from the best')
+g.add_argument('--shuffle-samples', action='store_true',
+               help='reshuffle individual samples into new batches every epoch')
+g.add_argument('--prefetch', type=int, default=0, metavar='N',
+               help='prepare up to N batches ahead in background threads')
+g.add_argument('--prefetch-threads', type=int, default=1, metavar='N',
+               help='use N background threads to prefetch batches')
+g.add_argument('--workers', type=int, default=0, metavar='N',
+               help='generate batches from callables in N worker processes')
+g.add_argument('--resident', action='store_true',
+               help='keep datasets in theano shared variables during training')
+g.add_argument('--quantize', choices=('uint8', 'float16'),
+               help='store dataset samples in memory with reduced precision')
+g.add_argument('--dataset-seed', type=int, metavar='N',
+               help='shuffle datasets with a random generator seeded with N')
+g.add_argument('--importance-sampling', action='store_true',
+               help='draw training batches in proportion to their loss')
+g.add_argument('--monitor-stats', action='store_true',
+               help='report std, min, and max of monitors across mini-batches')
+g.add_argument('--function-cache', metavar='DIR',
+               help='store compiled theano functions in DIR for reuse')
+g.add_argument('--combine-functions', action='store_true',
+               help='compile one function for both evaluation and learning')
 g.add_argument('--save-progress', metavar='FILE',
                help='save the model periodically to FILE')
 g.add_argument('--save-every', type=float, default=0, metavar='N',
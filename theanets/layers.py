@@ -5,6 +5,7 @@ import functools
 import numpy as np
 import sys
 import theano
+import theano.sparse
 import theano.tensor as TT
 
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
@@ -527,9 +528,15 @@ class Feedforward(Layer):
         updates : sequence of update tuples
             A sequence of updates to apply inside a theano function.
         '''
+        def dot(x, w):
+            # sparse inputs (e.g., from the network's input layer) only need to
+            # multiply their nonzero values.
+            if isinstance(x.type, theano.sparse.SparseType):
+                return theano.sparse.structured_dot(x, w)
+            return TT.dot(x, w)
         if not hasattr(inputs, '__len__'):
             inputs = (inputs, )
-        xs = (TT.dot(x, self.find(str(i))) for i, x in enumerate(inputs))
+        xs = (dot(x, self.find(str(i))) for i, x in enumerate(inputs))
         output = self.activate(sum(xs) + self.find('b'))
         return output, self._monitors(output), ()
 
@@ -676,6 +683,56 @@ class Maxout(Layer):
         return count
 
 
+class Embedding(Layer):
+    '''An embedding layer maps integer indices to learned vectors.
+
+    Embedding layers take integer inputs, such as word or symbol indices, and
+    look up a row of their weight table for each input value. With the default
+    linear activation, this is equivalent to multiplying a "one-hot" encoding
+    of the inputs by the weight table, but it never materializes the one-hot
+    inputs and only touches the weights that are looked up. Any other
+    activation is applied to the looked-up vectors. Note that layers created
+    from a network's layer specification use the network's
+    ``hidden_activation`` unless the specification names an activation, e.g.,
+    ``('embedding', 'linear', 5)``. Embedding layers are typically the first
+    layer after the input in networks created with ``input_type='index'``.
+
+    The input size of this layer (``nin``) is the number of distinct index
+    values (i.e., the vocabulary size), and the output size is the dimension of
+    the embedding vectors. Indices can have any shape; the output has one more
+    dimension than the input.
+    '''
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('activation', 'linear')
+        super(Embedding, self).__init__(**kwargs)
+
+    def setup(self):
+        '''Set up the parameters and initial values for this layer.'''
+        self.log_setup(self.add_weights('xh', std=1))
+
+    def transform(self, inputs):
+        '''Transform the inputs for this layer into an output for the layer.
+
+        Parameters
+        ----------
+        inputs : sequence of theano expressions
+            The inputs to this layer. There must be exactly one input, which
+            must contain integer indices.
+
+        Returns
+        -------
+        output : theano expression
+            Theano expression representing the output from the layer.
+        monitors : sequence of (name, expression) tuples
+            Outputs that can be used to monitor the state of this layer.
+        updates : sequence of update tuples
+            A sequence of updates to apply inside a theano function.
+        '''
+        output = self.activate(self.find('xh')[_only(inputs)])
+        return output, self._monitors(output), ()
+
+
 class Recurrent(Layer):
     '''A recurrent network layer incorporates some dependency on past values.
 
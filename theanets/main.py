@@ -6,7 +6,10 @@ and, especially, training a neural network model.
 
 import climate
 import datetime
+import gzip
+import numpy as np
 import os
+import pickle
 import sys
 import theano.tensor as TT
 import warnings
@@ -126,6 +129,8 @@ class Experiment:
         args, _ = climate.parse_known_args(**overrides)
 
         self.kwargs = vars(args)
+        self.datasets = {}
+        self._dataset_states = {}
 
         if self.kwargs.get('activation') and 'hidden_activation' not in overrides:
             warnings.warn(
@@ -208,12 +213,14 @@ class Experiment:
 
         Parameters
         ----------
-        data : ndarray, (ndarray, ndarray), or callable
+        data : ndarray, (ndarray, ndarray), str, or callable
             The values that you provide for data will be encapsulated inside a
             :class:`Dataset <dataset.Dataset>` instance; see that class for
             documentation on the types of things it needs. In particular, you
-            can currently pass in either a list/array/etc. of data, or a
-            callable that generates data dynamically.
+            can currently pass in either a list/array/etc. of data, the names
+            of ``.npy`` files to memory-map, the name of a directory containing
+            a :class:`sharded dataset <dataset.ShardedDataset>`, or a callable
+            that generates data dynamically.
 
         Returns
         -------
@@ -228,12 +235,42 @@ class Experiment:
             if len(data) > 1:
                 labels = data[1]
         name = kwargs.get('name', 'dataset')
+        subset = kwargs.get('valid_subset', self.kwargs.get('valid_subset'))
+        if name == 'valid' and subset and not callable(samples):
+            if isinstance(samples, str) and not os.path.isdir(samples):
+                samples = np.load(samples, mmap_mode='r')
+            if isinstance(labels, str):
+                labels = np.load(labels, mmap_mode='r')
+            if not isinstance(samples, str):
+                samples, labels = dataset.stratified_subset(
+                    samples, labels, subset, axis=kwargs.get('axis'),
+                    rng=kwargs.get('dataset_seed',
+                                   self.kwargs.get('dataset_seed')))
+        factory = dataset.Dataset
+        if isinstance(samples, str) and os.path.isdir(samples):
+            factory = dataset.ShardedDataset
+        elif name == 'train' and kwargs.get(
+                'importance_sampling',
+                self.kwargs.get('importance_sampling', False)):
+            factory = dataset.ImportanceDataset
         b, i, s = 'batch_size', 'iteration_size', '{}_batches'.format(name)
-        return dataset.Dataset(
+        # validation batches keep the same samples, so that (partial) passes
+        # over them are comparable.
+        shuffle = name != 'valid' and kwargs.get(
+            'shuffle_samples', self.kwargs.get('shuffle_samples', False))
+        return factory(
             samples, labels=labels, name=name,
             batch_size=kwargs.get(b, self.kwargs.get(b, 32)),
             iteration_size=kwargs.get(i, kwargs.get(s, self.kwargs.get(s))),
-            axis=kwargs.get('axis'))
+            axis=kwargs.get('axis'),
+            shuffle_samples=shuffle,
+            prefetch=kwargs.get('prefetch', self.kwargs.get('prefetch', 0)),
+            prefetch_threads=kwargs.get(
+                'prefetch_threads', self.kwargs.get('prefetch_threads', 1)),
+            workers=kwargs.get('workers', self.kwargs.get('workers', 0)),
+            resident=kwargs.get('resident', self.kwargs.get('resident', False)),
+            quantize=kwargs.get('quantize', self.kwargs.get('quantize')),
+            rng=kwargs.get('dataset_seed', self.kwargs.get('dataset_seed')))
 
     def run(self, *args, **kwargs):
         warnings.warn(
@@ -315,6 +352,14 @@ class Experiment:
             train_set = self.create_dataset(train_set, name='train', **kwargs)
         sets = dict(train_set=train_set, valid_set=valid_set, cg_set=train_set)
 
+        # resume iteration through the datasets, if we loaded a saved state.
+        self.datasets = dict(train=train_set, valid=valid_set)
+        for name, state in self._dataset_states.items():
+            if name in self.datasets:
+                logging.info('%s: restoring iteration state', name)
+                self.datasets[name].set_state(state)
+        self._dataset_states = {}
+
         # set up training algorithm(s)
         optimize = optimize or self.kwargs.get('optimize') or 'rmsprop'
         if isinstance(optimize, str):
@@ -344,6 +389,12 @@ class Experiment:
     def save(self, path):
         '''Save the current network to a pickle file on disk.
 
+        If the experiment is training, the iteration state of its datasets is
+        also saved, to a companion file with ".datasets" inserted before the
+        extension of `path` (e.g., "model.datasets.pkl.gz" for "model.pkl.gz").
+        Loading the network with :func:`load` also loads this state, so that
+        resumed training continues from the same point in the data.
+
         Parameters
         ----------
         path : str
@@ -351,6 +402,12 @@ class Experiment:
         '''
         logging.info('saving model to %s', path)
         self.network.save(path)
+        if self.datasets:
+            states = dict((n, d.get_state()) for n, d in self.datasets.items())
+            opener = gzip.open if path.lower().endswith('.gz') else open
+            handle = opener(_states_path(path), 'wb')
+            pickle.dump(states, handle, -1)
+            handle.close()
 
     def load(self, path, **kwargs):
         '''Load a saved network from a pickle file on disk.
@@ -374,4 +431,18 @@ class Experiment:
         '''
         logging.info('loading model from %s', path)
         self.network = feedforward.load(path, **kwargs)
+        states = _states_path(path)
+        if os.path.exists(states):
+            opener = gzip.open if path.lower().endswith('.gz') else open
+            handle = opener(states, 'rb')
+            self._dataset_states = pickle.load(handle)
+            handle.close()
+            logging.info('%s: loaded dataset states', states)
         return self.network
+
+
+def _states_path(path):
+    '''Get the path of the dataset state file that accompanies a saved model.'''
+    head, tail = os.path.split(path)
+    name, dot, ext = tail.partition('.')
+    return os.path.join(head, '{}.datasets{}{}'.format(name, dot, ext))
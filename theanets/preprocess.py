@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+
+r'''This module contains tools for preprocessing input data.
+
+Many models train faster when their inputs are centered and scaled, or even
+whitened so that input variables are uncorrelated. Computing these transforms
+usually requires holding an entire dataset in memory; the :class:`Statistics`
+class here instead accumulates the statistics of a dataset in a single pass over
+its mini-batches, so it also works for memory-mapped datasets and datasets that
+are generated by a callable.
+
+The transforms computed from these statistics are :class:`Affine` objects,
+which can be applied in two ways:
+
+- inside the computation graph of a network, by passing the transform as the
+  ``input_transform`` keyword argument when creating the network, or
+- to mini-batches as they are produced, by passing the transform as the
+  ``transform`` keyword argument when creating a
+  :class:`Dataset <theanets.dataset.Dataset>`.
+
+For example, to whiten the inputs of a model::
+
+  stats = theanets.preprocess.Statistics()
+  stats.accumulate(theanets.Dataset('train.npy', batch_size=1000))
+  whiten = stats.whiten(energy=0.99)
+  net = theanets.Autoencoder(
+      layers=(whiten.nout, 100, whiten.nout), input_transform=whiten)
+
+This module also contains an :class:`AugmentedDataset` that applies random
+data augmentations (e.g., :class:`RandomCrop`, :class:`RandomFlip`, and
+:class:`Jitter` for images) to the mini-batches of another dataset, using a pool
+of background threads so that augmentation overlaps with training::
+
+  train = theanets.preprocess.AugmentedDataset(
+      theanets.Dataset(images, batch_size=64),
+      [theanets.preprocess.RandomCrop((32, 32, 3), pad=4),
+       theanets.preprocess.RandomFlip((32, 32, 3)),
+       theanets.preprocess.Jitter(brightness=0.1, contrast=0.1)],
+      threads=4)
+'''
+
+import climate
+import numpy as np
+import theano
+import theano.tensor as TT
+import threading
+
+from .dataset import Dataset
+
+logging = climate.get_logger(__name__)
+
+FLOAT = theano.config.floatX
+
+
+class Affine(object):
+    r'''An affine transform of input data.
+
+    This transform maps an input :math:`x` to :math:`(x - b) W`, where the
+    offset :math:`b` is a vector, and :math:`W` is either a matrix or a vector
+    of (elementwise) scale values. Inputs can be ``numpy`` arrays or theano
+    expressions; in both cases the transform applies along the last axis.
+
+    Parameters
+    ----------
+    offset : ndarray
+        A vector to subtract from inputs.
+    scale : ndarray, optional
+        A vector of values to multiply the centered inputs by, elementwise.
+    matrix : ndarray, optional
+        A matrix to multiply the centered inputs by. Only one of `scale` and
+        `matrix` can be given; if neither is given, inputs are just centered.
+    '''
+
+    def __init__(self, offset, scale=None, matrix=None):
+        assert scale is None or matrix is None, 'give either scale or matrix'
+        self.offset = np.asarray(offset, FLOAT)
+        self.scale = None if scale is None else np.asarray(scale, FLOAT)
+        self.matrix = None if matrix is None else np.asarray(matrix, FLOAT)
+
+    @property
+    def nout(self):
+        '''The number of output variables produced by this transform.'''
+        if self.matrix is not None:
+            return self.matrix.shape[1]
+        return len(self.offset)
+
+    def __call__(self, x):
+        '''Apply this transform to some input data.
+
+        Parameters
+        ----------
+        x : ndarray or theano expression
+            Input data, with variables along the last axis.
+
+        Returns
+        -------
+        y : ndarray or theano expression
+            Transformed data.
+        '''
+        symbolic = isinstance(x, theano.Variable)
+        y = x - self.offset
+        if self.scale is not None:
+            y = y * self.scale
+        if self.matrix is not None:
+            y = TT.dot(y, self.matrix) if symbolic else np.dot(y, self.matrix)
+        return y if symbolic else y.astype(FLOAT)
+
+
+class Statistics(object):
+    '''Accumulate the mean, variance, and covariance of data in one pass.
+
+    Statistics are updated one chunk of samples at a time by combining the
+    moments of each chunk with the running moments, using the parallel form of
+    Welford's algorithm (Chan, Golub, and LeVeque, 1979). This is numerically
+    stable, and the result does not depend on how the data are chunked.
+
+    Samples are treated as rows, with variables along the last axis; chunks
+    with more than two dimensions (e.g., batches of sequences for recurrent
+    models) are flattened into rows.
+
+    Parameters
+    ----------
+    covariance : bool, optional
+        If True (the default), accumulate the full covariance matrix of the
+        variables, which is required for :func:`whiten`. Set this to False to
+        save time and memory when only the mean and variance are needed.
+
+    Attributes
+    ----------
+    count : int
+        The number of samples that have been accumulated.
+    mean : ndarray
+        The mean of the samples.
+    '''
+
+    def __init__(self, covariance=True):
+        self.track_covariance = covariance
+        self.count = 0
+        self.mean = None
+        self._m2 = None  # sums of squared deviations from the mean.
+        self._c2 = None  # sums of products of deviations from the mean.
+
+    def update(self, chunk):
+        '''Add a chunk of samples to the statistics.
+
+        Parameters
+        ----------
+        chunk : ndarray
+            An array of samples, with variables along the last axis.
+        '''
+        x = np.asarray(chunk, np.float64)
+        x = x.reshape((-1, x.shape[-1]))
+        n = len(x)
+        if n == 0:
+            return
+        mean = x.mean(axis=0)
+        dev = x - mean
+        m2 = (dev * dev).sum(axis=0)
+        c2 = np.dot(dev.T, dev) if self.track_covariance else None
+        if self.count == 0:
+            self.count, self.mean, self._m2, self._c2 = n, mean, m2, c2
+            return
+        total = self.count + n
+        delta = mean - self.mean
+        weight = self.count * n / float(total)
+        self.mean = self.mean + delta * (n / float(total))
+        self._m2 += m2 + delta * delta * weight
+        if self.track_covariance:
+            self._c2 += c2 + np.outer(delta, delta) * weight
+        self.count = total
+
+    def accumulate(self, dataset, batches=None):
+        '''Add the samples from the mini-batches of a dataset to the statistics.
+
+        Parameters
+        ----------
+        dataset : :class:`Dataset <theanets.dataset.Dataset>`
+            A dataset. Only the first array (i.e., the samples) of each
+            mini-batch is used.
+        batches : int, optional
+            The maximum number of mini-batches to accumulate. Defaults to all
+            of the batches in one iteration over the dataset.
+
+        Returns
+        -------
+        self : :class:`Statistics`
+            These statistics, for chaining calls.
+        '''
+        # iterate over one fixed pass, so that training on the dataset
+        # afterwards still starts at the beginning of an epoch.
+        index = getattr(dataset, '_index', None)
+        source = dataset.iterate_fixed()
+        try:
+            for i, batch in enumerate(source):
+                if batches and i >= batches:
+                    break
+                self.update(batch[0])
+        finally:
+            if hasattr(source, 'close'):
+                source.close()
+            if index is not None:
+                dataset._index = index
+        logging.info('accumulated statistics of %d samples from %s',
+                     self.count, dataset.name)
+        return self
+
+    @property
+    def variance(self):
+        '''The variance of each variable.'''
+        return self._m2 / self.count
+
+    @property
+    def std(self):
+        '''The standard deviation of each variable.'''
+        return np.sqrt(self.variance)
+
+    @property
+    def covariance(self):
+        '''The covariance matrix of the variables.'''
+        assert self.track_covariance, 'covariance was not accumulated'
+        return self._c2 / self.count
+
+    def center(self):
+        '''Get a transform that subtracts the mean from data.
+
+        Returns
+        -------
+        transform : :class:`Affine`
+            A centering transform.
+        '''
+        return Affine(self.mean)
+
+    def standardize(self, eps=1e-8):
+        '''Get a transform that gives each variable zero mean and unit variance.
+
+        Parameters
+        ----------
+        eps : float, optional
+            Add this value to standard deviations before dividing, to avoid
+            dividing by zero for constant variables. Defaults to 1e-8.
+
+        Returns
+        -------
+        transform : :class:`Affine`
+            A standardizing transform.
+        '''
+        return Affine(self.mean, scale=1 / (self.std + eps))
+
+    def whiten(self, energy=None, components=None, eps=1e-8):
+        '''Get a PCA whitening transform for data.
+
+        The transform centers data, projects it onto the principal components
+        of the covariance, and scales each projection to have unit variance.
+
+        Parameters
+        ----------
+        energy : float in (0, 1], optional
+            Retain the smallest number of components that accounts for at least
+            this fraction of the total variance.
+        components : int, optional
+            Retain this many components. If neither this nor `energy` is given,
+            all components are retained.
+        eps : float, optional
+            Add this value to component variances before dividing, to avoid
+            dividing by zero. Defaults to 1e-8.
+
+        Returns
+        -------
+        transform : :class:`Affine`
+            A whitening transform.
+        '''
+        vals, vecs = np.linalg.eigh(self.covariance)
+        vals, vecs = vals[::-1].clip(0), vecs[:, ::-1]
+        k = components or len(vals)
+        if energy is not None:
+            fraction = np.cumsum(vals) / vals.sum()
+            k = min(k, int(np.searchsorted(fraction, energy)) + 1)
+        logging.info('whitening with %d of %d components, %.1f%% of variance',
+                     k, len(vals), 100 * vals[:k].sum() / vals.sum())
+        return Affine(self.mean, matrix=vecs[:, :k] / np.sqrt(vals[:k] + eps))
+
+
+class RandomFlip(object):
+    '''Randomly mirror images in a mini-batch.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        The shape of one image, as (rows, columns) or (rows, columns, channels).
+        Each sample in a mini-batch is reshaped to this shape.
+    axis : int, optional
+        Flip images along this axis of the image shape. Defaults to 1, which
+        mirrors images from left to right.
+    probability : float in [0, 1], optional
+        Flip each image with this probability. Defaults to 0.5.
+    '''
+
+    def __init__(self, shape, axis=1, probability=0.5):
+        self.shape = tuple(shape)
+        self.axis = axis
+        self.probability = probability
+
+    def __call__(self, x, rng):
+        imgs = x.reshape((-1, ) + self.shape)
+        flip = rng.random_sample(len(imgs)) < self.probability
+        out = imgs.copy()
+        mirror = (slice(None), ) * (self.axis + 1) + (slice(None, None, -1), )
+        out[flip] = imgs[flip][mirror]
+        return out.reshape(x.shape)
+
+
+class RandomCrop(object):
+    '''Randomly shift images in a mini-batch by padding and cropping.
+
+    Each image is padded with zeros on all sides, and then an image of the
+    original size is cropped out of the padded image at a random offset.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        The shape of one image, as (rows, columns) or (rows, columns, channels).
+        Each sample in a mini-batch is reshaped to this shape.
+    pad : int
+        Pad images by this many pixels on each side, which is also the largest
+        possible shift in any direction.
+    '''
+
+    def __init__(self, shape, pad):
+        self.shape = tuple(shape)
+        self.pad = pad
+
+    def __call__(self, x, rng):
+        imgs = x.reshape((-1, ) + self.shape)
+        n, rows, cols = imgs.shape[:3]
+        p = self.pad
+        padded = np.pad(imgs, [(0, 0), (p, p), (p, p)] +
+                        [(0, 0)] * (imgs.ndim - 3), mode='constant')
+        # gather all crops at once using broadcast index grids.
+        r = rng.randint(0, 2 * p + 1, size=n)[:, None] + np.arange(rows)
+        c = rng.randint(0, 2 * p + 1, size=n)[:, None] + np.arange(cols)
+        out = padded[np.arange(n)[:, None, None], r[:, :, None], c[:, None, :]]
+        return out.reshape(x.shape)
+
+
+class Jitter(object):
+    '''Randomly perturb the intensity of samples in a mini-batch.
+
+    Parameters
+    ----------
+    brightness : float, optional
+        Add a value drawn uniformly from [-brightness, brightness] to all values
+        of each sample. Defaults to 0.
+    contrast : float, optional
+        Scale the deviations of each sample from its mean by a factor drawn
+        uniformly from [1 - contrast, 1 + contrast]. Defaults to 0.
+    noise : float, optional
+        Add gaussian noise with this standard deviation to every value.
+        Defaults to 0.
+    '''
+
+    def __init__(self, brightness=0, contrast=0, noise=0):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.noise = noise
+
+    def __call__(self, x, rng):
+        flat = x.reshape((len(x), -1))
+        out = flat.astype(FLOAT)
+        n = len(flat)
+        if self.contrast:
+            mean = out.mean(axis=1, keepdims=True)
+            scale = rng.uniform(1 - self.contrast, 1 + self.contrast, (n, 1))
+            out = mean + (out - mean) * scale.astype(FLOAT)
+        if self.brightness:
+            shift = rng.uniform(-self.brightness, self.brightness, (n, 1))
+            out += shift.astype(FLOAT)
+        if self.noise:
+            out += (self.noise * rng.randn(*out.shape)).astype(FLOAT)
+        return out.reshape(x.shape)
+
+
+class AugmentedDataset(Dataset):
+    '''A dataset that applies random augmentations to another dataset.
+
+    Mini-batches are drawn from the wrapped dataset and passed through a
+    sequence of augmentations. Each augmentation is a callable that takes an
+    array of samples (the first array of a mini-batch) and a ``numpy``
+    RandomState, and returns an augmented array of samples; augmentations
+    should operate on the whole mini-batch at once, using vectorized ``numpy``
+    operations (which release the global interpreter lock for most of their
+    work). Mini-batches are augmented by a pool of background threads and
+    queued, so that augmentation overlaps with computations on the model.
+
+    Parameters
+    ----------
+    dataset : :class:`Dataset <theanets.dataset.Dataset>`
+        A dataset to draw mini-batches from.
+    augmentations : sequence of callable
+        Augmentations to apply, in order, to each mini-batch.
+    threads : int, optional
+        Number of threads to use for augmentation. Defaults to 2.
+    prefetch : int, optional
+        Number of augmented mini-batches to prepare ahead of time. Defaults to
+        twice the number of threads. If this is 0, mini-batches are augmented
+        only when they are requested, without background threads.
+    rng : int or numpy RandomState, optional
+        A random number generator, or a seed for one, used to seed the random
+        draws for each augmented mini-batch.
+    '''
+
+    def __init__(self, dataset, augmentations, threads=2, prefetch=None,
+                 rng=None):
+        self.dataset = dataset
+        self.augmentations = list(augmentations)
+        self._lock = threading.Lock()
+        self._source = self._iter_source()
+        if prefetch is None:
+            prefetch = 2 * threads
+        Dataset.__init__(
+            self, self._augment, name=dataset.name,
+            batch_size=dataset.batch_size,
+            iteration_size=dataset.iteration_size,
+            prefetch=prefetch, prefetch_threads=threads, rng=rng)
+
+    def _iter_source(self):
+        '''Yield mini-batches from passes through the wrapped dataset.'''
+        while True:
+            for batch in self.dataset.iterate(True):
+                yield batch
+
+    def _augment(self):
+        '''Draw one mini-batch from the wrapped dataset and augment it.'''
+        with self._lock:
+            # copy the batch, since the wrapped dataset may reuse its buffers.
+            batch = [np.array(a) for a in next(self._source)]
+            rng = np.random.RandomState(self.rng.randint(1 << 30))
+        for augment in self.augmentations:
+            batch[0] = augment(batch[0], rng)
+        return batch
+
+    def get_state(self):
+        state = Dataset.get_state(self)
+        state['dataset'] = self.dataset.get_state()
+        return state
+
+    def set_state(self, state):
+        Dataset.set_state(self, state)
+        self.dataset.set_state(state['dataset'])
+
+    def close(self):
+        Dataset.close(self)
+        self.dataset.close()
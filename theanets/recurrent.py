@@ -5,6 +5,7 @@ import numpy as np
 import numpy.random as rng
 import theano
 import theano.tensor as TT
+import threading
 
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
@@ -16,7 +17,7 @@ logging = climate.get_logger(__name__)
 FLOAT = theano.config.floatX
 
 
-def batches(samples, labels=None, steps=100, batch_size=64):
+def batches(samples, labels=None, steps=100, batch_size=64, replace=True):
     '''Return a callable that generates samples from a dataset.
 
     Parameters
@@ -33,6 +34,12 @@ def batches(samples, labels=None, steps=100, batch_size=64):
         Generate this many samples per call. Defaults to 64. This must match the
         batch_size parameter that was used when creating the recurrent network
         that will process the data.
+    replace : bool, optional
+        If True (the default), the starting time step of each sample is drawn
+        independently at random. If False, starting time steps are drawn
+        without replacement from a random permutation of all possible starting
+        steps, and a new permutation is drawn once the current one is used up
+        (i.e., once per epoch through the data).
 
     Returns
     -------
@@ -40,20 +47,40 @@ def batches(samples, labels=None, steps=100, batch_size=64):
         A callable that can be used inside a dataset for training a recurrent
         network.
     '''
+    starts = len(samples) - steps
+    assert replace or starts >= batch_size, \
+        'need at least batch_size windows to sample without replacement'
+
+    # offsets[t, i] + start[i] gives the index of time step t for sample i.
+    offsets = np.arange(steps)[:, None]
+    epoch = dict(order=(), index=0)
+    lock = threading.Lock()
+
+    def draw():
+        if replace:
+            return rng.randint(starts, size=batch_size)
+        with lock:
+            if epoch['index'] + batch_size > len(epoch['order']):
+                epoch['order'] = rng.permutation(starts)
+                epoch['index'] = 0
+            i = epoch['index']
+            epoch['index'] += batch_size
+            return epoch['order'][i:i + batch_size]
+
+    def gather(arr, index):
+        # a single fancy-index gather lays out all windows in (steps, batch,
+        # dimensions) order, ready for the network. floatX data are written
+        # straight into the output; other dtypes need a converted copy.
+        if arr.dtype != FLOAT:
+            return arr[index].astype(FLOAT)
+        out = np.empty(index.shape + arr.shape[1:], FLOAT)
+        return np.take(arr, index, axis=0, out=out)
+
     def unlabeled_sample():
-        xs = np.zeros((steps, batch_size, samples.shape[1]), FLOAT)
-        for i in range(batch_size):
-            j = rng.randint(len(samples) - steps)
-            xs[:, i, :] = samples[j:j+steps]
-        return [xs]
+        return [gather(samples, offsets + draw())]
     def labeled_sample():
-        xs = np.zeros((steps, batch_size, samples.shape[1]), FLOAT)
-        ys = np.zeros((steps, batch_size, labels.shape[1]), FLOAT)
-        for i in range(batch_size):
-            j = rng.randint(len(samples) - steps)
-            xs[:, i, :] = samples[j:j+steps]
-            ys[:, i, :] = labels[j:j+steps]
-        return [xs, ys]
+        index = offsets + draw()
+        return [gather(samples, index), gather(labels, index)]
     return unlabeled_sample if labels is None else labeled_sample
 
 
@@ -78,6 +105,12 @@ class Network(feedforward.Network):
         Any of the hidden layers can be tapped at the output. Just specify a
         value greater than 1 to tap the last N hidden layers. The default is 1,
         which decodes from just the last layer.
+    mask : bool, optional
+        If True, the network takes an additional (time-steps, batch-size) input
+        matrix, following all other inputs, that weights the error at each time
+        step of each sequence. Use a mask of 0s and 1s to exclude the padding
+        of variable-length sequences from the error; see
+        :class:`theanets.dataset.SequenceDataset`. Defaults to False.
 
     Attributes
     ----------
@@ -88,10 +121,40 @@ class Network(feedforward.Network):
         network.
     '''
 
+    def __init__(self, **kwargs):
+        self.mask = TT.matrix('mask') if kwargs.get('mask') else None
+        super(Network, self).__init__(**kwargs)
+        if self.mask is not None:
+            self.inputs.append(self.mask)
+
     @property
     def error_start(self):
         return self.kwargs.get('recurrent_error_start', 3)
 
+    def _mean(self, values, start=0):
+        '''Average a (time-steps, batch-size) matrix of per-step values.
+
+        If the network has a mask, the average is weighted by the mask, so that
+        padding steps do not contribute.
+
+        Parameters
+        ----------
+        values : theano expression
+            A matrix of values, one for each time step of each sequence.
+        start : int, optional
+            The time step in the mask corresponding to the first row of values.
+            Defaults to 0.
+
+        Returns
+        -------
+        mean : theano expression
+            The (weighted) mean of the values.
+        '''
+        if self.mask is None:
+            return TT.mean(values)
+        weights = self.mask[start:]
+        return (values * weights).sum() / TT.maximum(1, weights.sum())
+
     def setup_vars(self):
         '''Setup Theano variables for our network.
 
@@ -102,7 +165,11 @@ class Network(feedforward.Network):
         '''
         # the first dimension indexes time, the second indexes the elements of
         # each minibatch, and the third indexes the variables in a given frame.
-        self.x = TT.tensor3('x')
+        # integer index inputs have no third dimension.
+        if self.kwargs.get('input_type', 'dense') == 'index':
+            self.x = TT.imatrix('x')
+        else:
+            self.x = TT.tensor3('x')
 
         return [self.x]
 
@@ -111,6 +178,24 @@ class Autoencoder(Network, feedforward.Autoencoder):
     '''An autoencoder network attempts to reproduce its input.
     '''
 
+    def error(self, output):
+        '''Build a theano expression for computing the network error.
+
+        Parameters
+        ----------
+        output : theano expression
+            A theano expression representing the output of the network.
+
+        Returns
+        -------
+        error : theano expression
+            A theano expression representing the network error.
+        '''
+        # sum over the variables in each frame, then average over time steps
+        # and sequences (weighted by the mask, if any).
+        err = output - self.x
+        return self._mean((err * err).sum(axis=-1))
+
 
 class Predictor(Autoencoder):
     '''A predictor network attempts to predict its next time step.
@@ -134,7 +219,7 @@ class Predictor(Autoencoder):
         # f(y)[0] to match x[1], f(y)[1] to match x[2], and so forth.
         error = self.x[1:] - self.generate_prediction(output)[:-1]
         err = error[self.error_start:]
-        return TT.mean((err * err).sum(axis=-1))
+        return self._mean((err * err).sum(axis=-1), self.error_start + 1)
 
     def generate_prediction(self, y):
         '''Given outputs from each time step, map them to subsequent inputs.
@@ -190,7 +275,7 @@ class Regressor(Network, feedforward.Regressor):
             A theano expression representing the network error.
         '''
         err = (output - self.targets)[self.error_start:]
-        return TT.mean((err * err).sum(axis=-1))
+        return self._mean((err * err).sum(axis=-1), self.error_start)
 
 
 class Classifier(Network, feedforward.Classifier):
@@ -228,7 +313,10 @@ class Classifier(Network, feedforward.Classifier):
         count = (output.shape[0] - self.error_start) * output.shape[1]
         correct = TT.reshape(self.labels[self.error_start:], (count, ))
         prob = TT.reshape(output[self.error_start:], (count, output.shape[2]))
-        return -TT.mean(TT.log(prob[TT.arange(count), correct]))
+        nlp = -TT.log(prob[TT.arange(count), correct])
+        return self._mean(
+            TT.reshape(nlp, self.labels[self.error_start:].shape),
+            self.error_start)
 
     def accuracy(self, output):
         '''Build a theano expression for computing the network accuracy.
@@ -245,4 +333,4 @@ class Classifier(Network, feedforward.Classifier):
         '''
         predict = TT.argmax(output, axis=-1)
         correct = TT.eq(predict, self.labels)
-        return TT.cast(100, FLOAT) * TT.mean(correct.flatten())
+        return TT.cast(100, FLOAT) * self._mean(correct)
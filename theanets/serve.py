@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+
+r'''This module contains a micro-batching inference server.
+
+Calling a compiled model once per request is wasteful when many requests arrive
+at about the same time: each call pays the full overhead of entering the
+compiled function, and a one-row matrix product makes poor use of the hardware.
+A :class:`Server` wraps a model (a :class:`Network
+<theanets.feedforward.Network>` or an :class:`Engine <theanets.engine.Engine>`)
+and lets any number of threads submit requests to it. A single worker thread
+collects queued requests into micro-batches---up to ``max_batch_size`` rows,
+waiting at most ``max_wait`` seconds after the first request for more to
+arrive---runs one call of the model on each batch, and hands every request its
+own rows of the result::
+
+  server = theanets.serve.Server(net, method='classify')
+  label = server(x[0])  # safe to call from many threads at once.
+
+The server can also be exposed to other processes with :func:`http_frontend`
+(which accepts POSTed JSON) or :func:`unix_frontend` (which reads one JSON
+request per line from a Unix socket). Use :func:`benchmark` to measure the
+latency and throughput of a server under concurrent load.
+'''
+
+import climate
+import collections
+import json
+import numpy as np
+import threading
+import time
+
+try:
+    import queue
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2.x
+    import Queue as queue
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+logging = climate.get_logger(__name__)
+
+
+class Request(object):
+    '''A pending request for a :class:`Server`.
+
+    Parameters
+    ----------
+    x : ndarray
+        Input data for the request: either a single example (a vector) or
+        several examples arranged as rows of a matrix.
+    '''
+
+    def __init__(self, x):
+        x = np.asarray(x)
+        if x.ndim == 0:
+            raise ValueError('cannot compute a scalar input')
+        self.single = x.ndim == 1
+        self.x = x[None] if self.single else x
+        self.created = time.time()
+        self._done = threading.Event()
+        self._result = self._error = None
+
+    def __len__(self):
+        return len(self.x)
+
+    def _finish(self, result=None, error=None):
+        self._result, self._error = result, error
+        self._done.set()
+
+    def done(self):
+        '''Return True if this request has been computed.'''
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''Wait for the result of this request.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum number of seconds to wait. Defaults to waiting forever.
+
+        Returns
+        -------
+        y : ndarray
+            Output of the model for this request. If the request was a single
+            example, this is the output for that example alone.
+
+        Raises
+        ------
+        RuntimeError :
+            If the request does not finish within the given timeout.
+        '''
+        if not self._done.wait(timeout):
+            raise RuntimeError('request timed out')
+        if self._error is not None:
+            raise self._error
+        return self._result[0] if self.single else self._result
+
+
+class Server(object):
+    '''Compute the outputs of a model for concurrent requests in batches.
+
+    Parameters
+    ----------
+    model : object
+        A model to serve, usually a :class:`Network
+        <theanets.feedforward.Network>` or :class:`Engine
+        <theanets.engine.Engine>`.
+    method : str, optional
+        Name of the method of the model to call on each batch, e.g.,
+        'predict' or 'classify'. The method must take a matrix of inputs and
+        return an array with one row (or value) per input row. Defaults to
+        'predict'. If a call fails, the requests in the batch are retried one
+        at a time, so a malformed request does not fail the others.
+    max_batch_size : int, optional
+        Maximum number of rows to compute in one call. Requests with more rows
+        than this are computed on their own. Defaults to 64.
+    max_wait : float, optional
+        Maximum number of seconds to wait for more requests after the first
+        request in a batch arrives. Defaults to 0.002.
+    '''
+
+    def __init__(self, model, method='predict', max_batch_size=64,
+                 max_wait=0.002):
+        self.model = model
+        self.method = getattr(model, method)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = self.requests = 0
+        self._queue = queue.Queue()
+        self._pending = []
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, x):
+        '''Queue a request without waiting for its result.
+
+        Parameters
+        ----------
+        x : ndarray
+            A single example (a vector), or several examples as rows.
+
+        Returns
+        -------
+        request : :class:`Request`
+            The queued request; call its ``result`` method to wait for the
+            output of the model.
+        '''
+        if self._thread is None:
+            raise RuntimeError('server is closed')
+        request = Request(x)
+        self._queue.put(request)
+        return request
+
+    def predict(self, x, timeout=None):
+        '''Compute the output of the model for some input.
+
+        Parameters
+        ----------
+        x : ndarray
+            A single example (a vector), or several examples as rows.
+        timeout : float, optional
+            Maximum number of seconds to wait. Defaults to waiting forever.
+
+        Returns
+        -------
+        y : ndarray
+            The output of the model for the input.
+        '''
+        return self.submit(x).result(timeout)
+
+    __call__ = predict
+
+    def close(self):
+        '''Stop the worker thread after finishing all queued requests.'''
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _collect(self):
+        '''Block until a request arrives, then collect a batch of requests.'''
+        first = self._pending.pop() if self._pending else self._queue.get()
+        if first is None:
+            return None
+        batch, size = [first], len(first)
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch_size:
+            try:
+                request = self._queue.get(
+                    timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if request is None or size + len(request) > self.max_batch_size:
+                # keep this one for the next batch.
+                self._pending.append(request)
+                break
+            batch.append(request)
+            size += len(request)
+        return batch
+
+    def _run(self):
+        '''Compute batches of requests until the server is closed.'''
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+            self._compute(batch)
+
+    def _compute(self, batch):
+        '''Compute the outputs for a batch of requests.
+
+        If the batch fails (e.g., because one request has the wrong shape),
+        its requests are computed one at a time, so that only the bad requests
+        receive an error.
+        '''
+        try:
+            x = batch[0].x if len(batch) == 1 else \
+                np.concatenate([r.x for r in batch])
+            # copy, since a model may reuse its output buffers.
+            y = np.array(self.method(x))
+        except Exception as error:
+            if len(batch) == 1:
+                logging.exception('error computing request')
+                batch[0]._finish(error=error)
+                return
+            y = None
+        if y is None:
+            for request in batch:
+                self._compute([request])
+            return
+        offset = 0
+        for request in batch:
+            request._finish(result=y[offset:offset + len(request)])
+            offset += len(request)
+        self.batches += 1
+        self.requests += len(batch)
+
+
+def _respond(server, body):
+    '''Decode a JSON request, compute it, and encode the JSON response.'''
+    y = server(np.asarray(json.loads(body)['inputs'], 'f'))
+    return json.dumps(dict(outputs=np.asarray(y).tolist()))
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            response, status = _respond(self.server.model, body.decode()), 200
+        except Exception as error:
+            response, status = json.dumps(dict(error=str(error))), 400
+        response = response.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+class _UnixHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = _respond(self.server.model, line.decode())
+            except Exception as error:
+                response = json.dumps(dict(error=str(error)))
+            self.wfile.write(response.encode() + b'\n')
+            self.wfile.flush()
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn,
+                           socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def http_frontend(server, host='127.0.0.1', port=8000):
+    '''Create an HTTP frontend for a server.
+
+    The frontend handles each connection in its own thread, so concurrent
+    requests are batched together. Clients POST a JSON object like
+    ``{"inputs": [[0.1, 0.2, ...]]}`` to any path, and receive a JSON object
+    like ``{"outputs": [...]}``, or ``{"error": "..."}`` with status 400.
+
+    Parameters
+    ----------
+    server : :class:`Server`
+        The server that computes requests.
+    host : str, optional
+        Address to listen on. Defaults to '127.0.0.1'.
+    port : int, optional
+        Port to listen on; use 0 to pick a free port. Defaults to 8000.
+
+    Returns
+    -------
+    frontend : ``HTTPServer``
+        The frontend. Call its ``serve_forever`` method (possibly in another
+        thread) to handle requests, and ``shutdown`` to stop.
+    '''
+    frontend = _ThreadingHTTPServer((host, port), _HTTPHandler)
+    frontend.model = server
+    logging.info('serving HTTP on %s:%d', *frontend.server_address[:2])
+    return frontend
+
+
+def unix_frontend(server, path):
+    '''Create a Unix socket frontend for a server.
+
+    Clients write one JSON request per line, in the same format as for
+    :func:`http_frontend`, and read one JSON response per line.
+
+    Parameters
+    ----------
+    server : :class:`Server`
+        The server that computes requests.
+    path : str
+        Filesystem path of the socket. It must not exist yet.
+
+    Returns
+    -------
+    frontend : ``UnixStreamServer``
+        The frontend. Call its ``serve_forever`` method (possibly in another
+        thread) to handle requests, and ``shutdown`` to stop.
+    '''
+    frontend = _ThreadingUnixServer(path, _UnixHandler)
+    frontend.model = server
+    logging.info('serving on unix socket %s', path)
+    return frontend
+
+
+def benchmark(predict, x, clients=16, requests=1000):
+    '''Measure the latency and throughput of concurrent single requests.
+
+    Parameters
+    ----------
+    predict : callable
+        A callable that computes the output for one example, e.g., a
+        :class:`Server`, or a function that calls a model directly (to measure
+        the performance of unbatched requests).
+    x : ndarray
+        Examples to submit, as rows; requests cycle through these rows.
+    clients : int, optional
+        Number of threads that submit requests concurrently. Defaults to 16.
+    requests : int, optional
+        Total number of requests to submit. Defaults to 1000.
+
+    Returns
+    -------
+    report : OrderedDict
+        A dictionary containing the number of requests completed per second,
+        and the mean, median, 99th percentile, and maximum latency of requests
+        in milliseconds.
+    '''
+    latencies = []
+    lock = threading.Lock()
+
+    def client(index):
+        times = []
+        for i in range(index, requests, clients):
+            start = time.time()
+            predict(x[i % len(x)])
+            times.append(time.time() - start)
+        with lock:
+            latencies.extend(times)
+
+    threads = [threading.Thread(target=client, args=(i, ))
+               for i in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    latencies = 1000 * np.asarray(latencies)
+    report = collections.OrderedDict()
+    report['throughput'] = requests / elapsed
+    report['mean_latency'] = float(latencies.mean())
+    report['median_latency'] = float(np.percentile(latencies, 50))
+    report['p99_latency'] = float(np.percentile(latencies, 99))
+    report['max_latency'] = float(latencies.max())
+    return report
@@ -31,10 +31,13 @@ import theano
 import theano.tensor as TT
 import sys
 
+from theano.ifelse import ifelse
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
+from . import cache
 from . import feedforward
 from . import layers
+from . import recurrent
 
 logging = climate.get_logger(__name__)
 
@@ -71,6 +74,77 @@ def ipcluster_mapper(client):
     return mapper
 
 
+class MonitorAccumulator(object):
+    '''Accumulate running statistics of monitor values over mini-batches.
+
+    Monitor values for each mini-batch are merged into running totals as they
+    are added, so the memory used does not depend on the number of batches.
+    Each batch is weighted, normally by the number of samples it contains, so
+    that a short final batch counts for less than a full one.
+
+    Parameters
+    ----------
+    names : sequence of str
+        Names of the monitors being accumulated.
+    stats : bool, optional
+        If True, also track the (weighted) standard deviation, minimum, and
+        maximum of each monitor across batches. Defaults to False.
+    '''
+
+    def __init__(self, names, stats=False):
+        self.names = list(names)
+        self.stats = stats
+        self.count = 0
+        self.weight = 0.
+        self.mean = np.zeros(len(self.names))
+        self._sumsq = np.zeros(len(self.names))
+        self._min = np.full(len(self.names), np.inf)
+        self._max = np.full(len(self.names), -np.inf)
+
+    def add(self, values, weight=1.):
+        '''Add the monitor values for one mini-batch.
+
+        Parameters
+        ----------
+        values : sequence of float
+            Monitor values for the batch, in the same order as our names.
+        weight : float, optional
+            Weight for the batch. Defaults to 1.
+        '''
+        values = np.asarray(values, float)
+        self.count += 1
+        self.weight += weight
+        delta = values - self.mean
+        self.mean += delta * (weight / self.weight)
+        self._sumsq += weight * delta * (values - self.mean)
+        np.minimum(self._min, values, out=self._min)
+        np.maximum(self._max, values, out=self._max)
+
+    @property
+    def variance(self):
+        '''Weighted variance of each monitor across batches.'''
+        return self._sumsq / max(self.weight, 1e-100)
+
+    def monitors(self):
+        '''Get a dictionary of accumulated monitor values.
+
+        Returns
+        -------
+        monitors : OrderedDict
+            A dictionary mapping monitor names to weighted means. If we track
+            statistics, there are also "_std", "_min", and "_max" entries for
+            each monitor.
+        '''
+        monitors = collections.OrderedDict(zip(self.names, self.mean))
+        if self.stats:
+            std = np.sqrt(self.variance)
+            for i, name in enumerate(self.names):
+                monitors[name + '_std'] = std[i]
+                monitors[name + '_min'] = self._min[i]
+                monitors[name + '_max'] = self._max[i]
+        return monitors
+
+
 class Trainer(object):
     '''All trainers derive from this base class.
 
@@ -88,7 +162,7 @@ class Trainer(object):
         the current parameter settings.
     f_eval : theano function
         A function that takes some data and returns a sequence of monitor values
-        for that data.
+        for that data. It is compiled the first time it is used.
 
     Parameters
     ----------
@@ -102,6 +176,30 @@ class Trainer(object):
     patience : int, optional
         Maximum number of validations that can pass before the validation loss
         must improve by `min_improvement` relative. Defaults to 10.
+    valid_confidence : float, optional
+        If positive, walk the validation batches in a fixed order and stop
+        validating as soon as the mean validation loss is more than this many
+        standard errors away from the loss needed to count as an improvement,
+        i.e., once the outcome of :func:`test_patience` is clear. Defaults to
+        0, which always validates on the entire validation set.
+    valid_min_batches : int, optional
+        Always validate on at least this many batches when `valid_confidence`
+        is positive. Defaults to 3.
+    monitor_stats : bool, optional
+        If True, report the standard deviation, minimum, and maximum of each
+        monitor across mini-batches, in addition to its mean. Defaults to
+        False.
+    function_cache : str, optional
+        A directory for storing compiled functions (see
+        :class:`FunctionCache <theanets.cache.FunctionCache>`). Defaults to
+        None, which compiles functions every time.
+    function_cache_size : int, optional
+        Maximum size of the function cache, in bytes. Defaults to 1 GB.
+    combine_functions : bool, optional
+        If True, SGD-based trainers compile a single function that can either
+        evaluate or train the model, instead of separate evaluation and
+        learning functions. This roughly halves the time spent compiling.
+        Defaults to False.
     '''
 
     def __init__(self, network, **kwargs):
@@ -110,6 +208,9 @@ class Trainer(object):
         self.validate_every = kwargs.get('validate_every', 10)
         self.min_improvement = kwargs.get('min_improvement', 0.)
         self.patience = kwargs.get('patience', 10)
+        self.valid_confidence = kwargs.get('valid_confidence', 0)
+        self.valid_min_batches = kwargs.get('valid_min_batches', 3)
+        self.monitor_stats = kwargs.get('monitor_stats', False)
 
         self.params = network.params
         self._shapes = [p.get_value(borrow=True).shape for p in self.params]
@@ -128,9 +229,119 @@ class Trainer(object):
             self._monitor_names.append(name)
             self._monitor_exprs.append(monitor)
 
-        logging.info('compiling evaluation function')
-        self.f_eval = theano.function(
-            network.inputs, self._monitor_exprs, updates=updates)
+        self._inputs = network.inputs
+        self._updates = list(updates)
+        self._batch_axis = 1 if isinstance(network, recurrent.Network) else 0
+        self._resident = {}
+
+        self._cache = kwargs.get('function_cache')
+        if self._cache:
+            self._cache = cache.FunctionCache(
+                self._cache, kwargs.get('function_cache_size', 1 << 30))
+
+        self._f_eval = None
+
+    @property
+    def f_eval(self):
+        if self._f_eval is None:
+            logging.info('compiling evaluation function')
+            self._f_eval = self.compile(
+                'eval', self._inputs, self._monitor_exprs,
+                updates=self._updates)
+        return self._f_eval
+
+    def compile(self, name, inputs, outputs, **kwargs):
+        '''Compile a theano function, using our function cache if any.
+
+        Parameters
+        ----------
+        name : str
+            A name for the function, used to distinguish it in the cache.
+        inputs : list of theano variables
+            Explicit inputs of the function.
+        outputs : list of theano expressions
+            Outputs of the function.
+
+        Other keyword arguments are passed to ``theano.function``.
+
+        Returns
+        -------
+        function : theano function
+            A compiled function.
+        '''
+        return cache.function(inputs, outputs, cache=self._cache,
+                              key=(name, self.__class__.__name__), **kwargs)
+
+    def resident_function(self, dataset, updates=(), name='eval',
+                          fixed=False):
+        '''Get a function that computes monitors on a resident dataset.
+
+        A resident dataset keeps its data in theano shared variables; functions
+        for these datasets take the offsets of a mini-batch as input and slice
+        the batch out of the shared data inside the computation graph. These
+        functions are compiled the first time they are needed for a dataset.
+
+        Parameters
+        ----------
+        dataset : :class:`Dataset <theanets.dataset.Dataset>`
+            A resident dataset.
+        updates : sequence of update tuples, optional
+            Updates to perform when computing the function (for example,
+            parameter updates during learning), in addition to the updates
+            required by the network graph.
+        name : str, optional
+            A name for the function. Defaults to 'eval'.
+        fixed : bool, optional
+            If True, the function takes offsets into the original order of
+            samples, as yielded by :func:`Dataset.iterate_fixed
+            <theanets.dataset.Dataset.iterate_fixed>`. Defaults to False.
+
+        Returns
+        -------
+        function : theano function
+            A function that takes (start, stop) offsets of a mini-batch and
+            returns a sequence of monitor values for that batch.
+        '''
+        key = name, id(dataset), fixed
+        if key not in self._resident or self._resident[key][0] is not dataset:
+            logging.info('compiling resident %s function for %s',
+                         name, dataset.name)
+            start, stop = TT.lscalar('start'), TT.lscalar('stop')
+            # the givens are part of the cache fingerprint, so functions for
+            # datasets of different shapes or layouts are stored separately.
+            self._resident[key] = dataset, self.compile(
+                'resident_' + name,
+                [start, stop],
+                self._monitor_exprs,
+                updates=self._updates + list(updates),
+                givens=dataset.givens(self._inputs, start, stop, fixed))
+        return self._resident[key][1]
+
+    def accumulator(self):
+        '''Create an accumulator for our monitor values.'''
+        return MonitorAccumulator(self._monitor_names, self.monitor_stats)
+
+    def batch_size(self, batch, dataset=None):
+        '''Get the number of samples in a mini-batch.
+
+        Parameters
+        ----------
+        batch : sequence of ndarray, or (int, int)
+            A mini-batch of arrays, or the (start, stop) offsets of a batch in
+            a resident dataset.
+        dataset : :class:`Dataset <theanets.dataset.Dataset>`, optional
+            The dataset that the mini-batch came from. For offsets, this is
+            used to trim the last batch to the number of samples available.
+
+        Returns
+        -------
+        size : int
+            Number of samples in the mini-batch.
+        '''
+        if isinstance(batch[0], (int, np.integer)):
+            start, stop = batch
+            return min(stop, getattr(dataset, 'number_samples', stop)) - start
+        return batch[0].shape[self._batch_axis]
 
     def set_params(self, targets):
         '''Set the values of the parameters to the given target values.
@@ -185,9 +396,62 @@ class Trainer(object):
             quantities of interest during training---for example, loss function,
             accuracy, or whatever the layers in the network define.
         '''
-        values = [self.f_eval(*x) for x in dataset]
-        monitors = zip(self._monitor_names, np.mean(values, axis=0))
-        return collections.OrderedDict(monitors)
+        f_eval, batches = self.f_eval, dataset
+        if getattr(dataset, 'resident', False):
+            f_eval = self.resident_function(dataset)
+            batches = dataset.iterate_offsets()
+        monitors = self.accumulator()
+        for x in batches:
+            monitors.add(f_eval(*x), self.batch_size(x, dataset))
+        return monitors.monitors()
+
+    def validate(self, dataset):
+        '''Evaluate the current model on a validation dataset.
+
+        If `valid_confidence` is positive, mini-batches are evaluated in a
+        fixed order (see :func:`Dataset.iterate_fixed
+        <theanets.dataset.Dataset.iterate_fixed>`) until the mean loss is
+        confidently above or below the loss that :func:`test_patience` would
+        count as an improvement. Otherwise, this is the same as
+        :func:`evaluate`.
+
+        Parameters
+        ----------
+        dataset : :class:`Dataset <theanets.dataset.Dataset>`
+            A set of data to use for validating the model.
+
+        Returns
+        -------
+        monitors : OrderedDict
+            A dictionary mapping monitor names to values, averaged over the
+            mini-batches that were evaluated.
+        '''
+        if self.valid_confidence <= 0 or self._best_loss >= 1e100 or \
+                not hasattr(dataset, 'iterate_fixed'):
+            return self.evaluate(dataset)
+        resident = getattr(dataset, 'resident', False)
+        f_eval = self.f_eval
+        if resident:
+            f_eval = self.resident_function(dataset, name='fixed', fixed=True)
+        target = self._best_loss * (1 - self.min_improvement)
+        batches = dataset.iterate_fixed(offsets=resident)
+        monitors = self.accumulator()
+        try:
+            for x in batches:
+                monitors.add(f_eval(*x), self.batch_size(x, dataset))
+                n = monitors.count
+                if n < max(2, self.valid_min_batches):
+                    continue
+                error = np.sqrt(monitors.variance[0] / (n - 1))
+                if abs(monitors.mean[0] - target) > \
+                        self.valid_confidence * error:
+                    logging.info('%s: stopped validation after %d batches',
+                                 dataset.name, n)
+                    break
+        finally:
+            if hasattr(batches, 'close'):
+                batches.close()
+        return monitors.monitors()
 
     def test_patience(self, monitors):
         '''Test whether our patience with training has elapsed.
@@ -242,14 +506,20 @@ class Trainer(object):
             A dictionary containing monitor values evaluated on the validation
             dataset.
         '''
+        def interrupted():
+            logging.info('interrupted!')
+            for dataset in (train_set, valid_set):
+                if hasattr(dataset, 'close'):
+                    dataset.close()
+
         iteration = 0
         training = validation = None
         while True:
             if not iteration % self.validate_every:
                 try:
-                    validation = self.evaluate(valid_set)
+                    validation = self.validate(valid_set)
                 except KeyboardInterrupt:
-                    logging.info('interrupted!')
+                    interrupted()
                     break
                 if self.test_patience(validation):
                     logging.info('patience elapsed!')
@@ -257,7 +527,7 @@ class Trainer(object):
             try:
                 training = self.step(train_set)
             except KeyboardInterrupt:
-                logging.info('interrupted!')
+                interrupted()
                 break
             iteration += 1
             self.log(training, iteration)
@@ -287,6 +557,9 @@ class SGD(Trainer):
     some information about second-order derivatives of the loss surface.
     '''
 
+    # True for trainers whose updates ignore the scale of the gradient.
+    SIGN_BASED = False
+
     def __init__(self, network, **kwargs):
         super(SGD, self).__init__(network, **kwargs)
 
@@ -294,11 +567,42 @@ class SGD(Trainer):
         self.momentum = TT.cast(kwargs.get('momentum', 0.9), FLOAT)
         self.learning_rate = TT.cast(kwargs.get('learning_rate', 1e-4), FLOAT)
 
-        _, _, updates = network.loss(**kwargs)
-        logging.info('compiling %s learning function', self.__class__.__name__)
-        updates = list(updates) + list(self.learning_updates())
-        self.f_learn = theano.function(
-            network.inputs, self._monitor_exprs, updates=updates)
+        # parameter steps are scaled by the correction weight of importance-
+        # sampled mini-batches (see theanets.dataset.ImportanceDataset). plain
+        # and momentum SGD scale the clipped gradient; RmsProp, ADADELTA, and
+        # ESGD would mostly cancel a weighted gradient when dividing by its
+        # running magnitude, so they scale the normalized step instead. Rprop
+        # ignores gradient magnitudes and cannot use importance sampling.
+        self.batch_weight = theano.shared(
+            np.cast[FLOAT](1), name='batch_weight')
+
+        self._learning_updates = list(self.learning_updates())
+        if kwargs.get('combine_functions'):
+            self._compile_combined()
+        else:
+            logging.info('compiling %s learning function',
+                         self.__class__.__name__)
+            self.f_learn = self.compile(
+                'learn', self._inputs, self._monitor_exprs,
+                updates=self._updates + self._learning_updates)
+
+    def _compile_combined(self):
+        '''Compile one function that both evaluates and trains the model.
+
+        The function takes an extra integer input; the learning updates are
+        only computed and applied when it is nonzero. Evaluation and learning
+        share most of their graph, so compiling them together takes about as
+        long as compiling either one alone.
+        '''
+        logging.info('compiling %s combined function', self.__class__.__name__)
+        learn = TT.iscalar('learn')
+        updates = [(var, ifelse(learn, expr, var))
+                   for var, expr in self._learning_updates]
+        f_both = self.compile(
+            'combined', self._inputs + [learn], self._monitor_exprs,
+            updates=self._updates + updates)
+        self.f_learn = lambda *x: f_both(*(tuple(x) + (1, )))
+        self._f_eval = lambda *x: f_both(*(tuple(x) + (0, )))
 
     def learning_updates(self):
         for param, grad in zip(self.params, self.clipped_gradients()):
@@ -307,10 +611,15 @@ class SGD(Trainer):
             yield vel_tm1, vel_t
             yield param, param + vel_t
 
-    def clipped_gradients(self, params=None):
+    def clipped_gradients(self, params=None, weighted=True):
+        # the importance weight scales the clipped gradient; scaling the loss
+        # instead would let the clip undo the correction for large gradients.
+        # trainers that normalize gradients by their running magnitude ask for
+        # unweighted gradients and apply the weight to the normalized step.
         for grad in TT.grad(self.loss, params or self.params):
             norm = TT.sqrt((grad * grad).sum())
-            yield grad * TT.minimum(TT.cast(1, FLOAT), self.max_norm / norm)
+            grad = grad * TT.minimum(TT.cast(1, FLOAT), self.max_norm / norm)
+            yield self.batch_weight * grad if weighted else grad
 
     @staticmethod
     def shared_like(param, name, init=0):
@@ -330,9 +639,30 @@ class SGD(Trainer):
         training : dict
             A dictionary mapping monitor names to values.
         '''
-        values = [self.f_learn(*x) for x in dataset]
-        return collections.OrderedDict(
-            zip(self._monitor_names, np.mean(values, axis=0)))
+        f_learn, batches = self.f_learn, dataset
+        if getattr(dataset, 'resident', False):
+            f_learn = self.resident_function(
+                dataset, self._learning_updates, 'learn')
+            batches = dataset.iterate_offsets()
+        monitors = self.accumulator()
+        if not callable(getattr(dataset, 'observe', None)):
+            for x in batches:
+                monitors.add(f_learn(*x), self.batch_size(x, dataset))
+            return monitors.monitors()
+        # importance-sampled batches carry a correction weight, and the loss of
+        # each batch is reported back to the dataset.
+        if self.SIGN_BASED:
+            raise ValueError('{} uses only the signs of gradients, so it '
+                             'cannot correct for importance sampling'.format(
+                                 self.__class__.__name__))
+        for x in batches:
+            weight = dataset.weight
+            self.batch_weight.set_value(np.cast[FLOAT](weight))
+            values = f_learn(*x)
+            monitors.add(values, weight * self.batch_size(x, dataset))
+            dataset.observe(values[0])
+        self.batch_weight.set_value(np.cast[FLOAT](1))
+        return monitors.monitors()
 
 
 class NAG(SGD):
@@ -422,8 +752,13 @@ class Rprop(SGD):
     in Algorithm 4 from Igel and Huesken, "Improving the Rprop Learning
     Algorithm" (2000). This variant resets the running gradient estimates to
     zero in cases where the previous and current gradients have switched signs.
+
+    Because the magnitude of the gradient is ignored, Rprop cannot be used with
+    importance-sampled datasets.
     '''
 
+    SIGN_BASED = True
+
     def __init__(self, network, **kwargs):
         self.step_increase = TT.cast(kwargs.get('rprop_increase', 1.01), FLOAT)
         self.step_decrease = TT.cast(kwargs.get('rprop_decrease', 0.99), FLOAT)
@@ -501,14 +836,16 @@ class RmsProp(SGD):
 
     def learning_updates(self):
         eps = 1e-4
-        for param, grad in zip(self.params, self.clipped_gradients()):
+        grads = self.clipped_gradients(weighted=False)
+        for param, grad in zip(self.params, grads):
             g1_tm1 = self.shared_like(param, 'g1_ewma')
             g2_tm1 = self.shared_like(param, 'g2_ewma')
             vel_tm1 = self.shared_like(param, 'vel')
             g1_t = self.ewma * g1_tm1 + (1 - self.ewma) * grad
             g2_t = self.ewma * g2_tm1 + (1 - self.ewma) * grad * grad
             rms = TT.sqrt(g2_t - g1_t * g1_t + eps)
-            vel_t = self.momentum * vel_tm1 - grad * self.learning_rate / rms
+            vel_t = self.momentum * vel_tm1 - \
+                self.batch_weight * grad * self.learning_rate / rms
             yield g1_tm1, g1_t
             yield g2_tm1, g2_t
             yield vel_tm1, vel_t
@@ -561,7 +898,8 @@ class ADADELTA(RmsProp):
 
     def learning_updates(self):
         eps = 1e-4
-        for param, grad in zip(self.params, self.clipped_gradients()):
+        grads = self.clipped_gradients(weighted=False)
+        for param, grad in zip(self.params, grads):
             x2_tm1 = self.shared_like(param, 'x2_ewma')
             g2_tm1 = self.shared_like(param, 'g2_ewma')
             g2_t = self.ewma * g2_tm1 + (1 - self.ewma) * grad * grad
@@ -569,7 +907,7 @@ class ADADELTA(RmsProp):
             x2_t = self.ewma * x2_tm1 + (1 - self.ewma) * delta * delta
             yield g2_tm1, g2_t
             yield x2_tm1, x2_t
-            yield param, param - delta
+            yield param, param - self.batch_weight * delta
 
 
 class ESGD(RmsProp):
@@ -620,12 +958,14 @@ class ESGD(RmsProp):
 
     def learning_updates(self):
         eps = 1e-4  # more or less from the paper
-        for param, grad in zip(self.params, self.clipped_gradients()):
+        grads = self.clipped_gradients(weighted=False)
+        for param, grad in zip(self.params, grads):
             D_tm1 = self.shared_like(param, 'D_ewma')
             vel_tm1 = self.shared_like(param, 'vel')
             Hv = TT.Rop(grad, param, self.rng.normal(param.shape))
             D_t = self.ewma * D_tm1 + (1 - self.ewma) * Hv * Hv
-            vel_t = self.momentum * vel_tm1 - grad * self.learning_rate / TT.sqrt(D_t + eps)
+            vel_t = self.momentum * vel_tm1 - self.batch_weight * grad * \
+                self.learning_rate / TT.sqrt(D_t + eps)
             yield D_tm1, D_t
             yield param, param + vel_t
 